@@ -12,12 +12,33 @@ aggreagate.py :  Module to take GeoJSON feature collection and return
 """
 
 import math
+import heapq
+import itertools
+import numpy as np
 import geojson
 import modules.cdi as cdi
 from modules.utm import OutOfRangeError,to_latlon,from_latlon
+from modules.utm import to_latlon_array,from_latlon_array
+from modules.cellcache import CellCache
 
 PRECISION=4
 
+# Cell IDs are packed into one integer:
+# (zone * 32 + zone letter) << 48 | x0/resolution << 24 | y0/resolution
+# 'None' is the zone letter from_latlon gives at exactly 84N
+ZONELETTERS=list('CDEFGHJKLMNPQRSTUVWX')+['None']
+CELLBITS=24
+
+# Cell sizes in km of the pyramid built by aggregatePyramid
+LEVELS=[1,5,10,20]
+
+# Centers and polygons of the cells seen so far (see modules.cellcache),
+# preload with cellcache.load(file)
+cellcache=CellCache()
+
+# Responses converted at a time by aggregateStream
+CHUNKSIZE=10000
+
 def aggregate(featurecollection,resolution):
     """
     Iterate through GeoJSON feature collection
@@ -32,48 +53,554 @@ def aggregate(featurecollection,resolution):
     Arguments:
     pts             GeoJSON feature collection
     resolution      size of geocoding box in km (optional, default 1km)
+
+    Responses are added in one pass to per-cell sums and counts of each
+    CDI index (see cdi.getMeans), keyed by integer cell ID (see
+    getCellIds). The input features are not modified.
     """
     resolutionMeters=resolution * 1000
     pts=featurecollection['features']
     npts=len(pts)
     print('Got '+str(npts)+' entries, aggregating.')
-    for pt in pts:
-        loc=getAggregation(pt,resolutionMeters)
-        if not loc: continue
-        pt['properties']['loc']=loc
-                
-    rawresults={}
-    earliesttimes={}
+    cellids=np.array(getCellIds(pts,resolutionMeters),dtype=np.int64)
+    values=cdi.getValueArray(pts)
+
     print('Aggregating points:')
-    for pt in pts:
-        if 'loc' not in pt['properties']: continue
-        loc=pt['properties']['loc']
-        if loc in rawresults:
-            rawresults[loc].append(pt)
-        else:
-            rawresults[loc]=[ pt ]
-
-            
+    results=aggregateCells(cellids,values,resolutionMeters)
+    print('Aggregated %i pts into %i pts' % (npts,len(results)))
+    return results
+
+
+def aggregatePyramid(featurecollection,levels=LEVELS):
+    """
+    Aggregate at several cell sizes in one pass
+    Returns a dict of cell size in km: result of aggregate() at that size
+
+    Cell IDs are computed once at the finest level. The coarser cells
+    are found by integer division of the fine UTM cell coordinates, so
+    each cell size must be a multiple of the finest one.
+
+    Arguments:
+    featurecollection   GeoJSON feature collection
+    levels              list of cell sizes in km (default LEVELS)
+    """
+
+    levels=sorted(levels)
+    fineMeters=levels[0] * 1000
+    pts=featurecollection['features']
+    print('Got %i entries, aggregating at %s km.' %
+          (len(pts),'/'.join([ str(x) for x in levels ])))
+    cellids=np.array(getCellIds(pts,fineMeters),dtype=np.int64)
+    values=cdi.getValueArray(pts)
+
+    pyramid={}
+    for resolution in levels:
+        resolutionMeters=resolution * 1000
+        ids=rollupCellIds(cellids,fineMeters,resolutionMeters)
+        pyramid[resolution]=aggregateCells(ids,values,resolutionMeters)
+        print('Level %s km: %i pts' % (resolution,len(pyramid[resolution])))
+
+    return pyramid
+
+
+def aggregateStream(responses,levels=LEVELS,chunksize=CHUNKSIZE):
+    """
+    Same as aggregatePyramid, for an iterable of responses (e.g. the
+    Db.iterext generator) that is read once, in chunks
+    Returns a dict of cell size in km: result of aggregate() at that size
+
+    Only one chunk of responses is held at a time, the rest of the
+    memory used grows with the number of cells (see CellAccumulator)
+
+    Arguments:
+    responses   iterable of GeoJSON Features
+    levels      list of cell sizes in km (default LEVELS)
+    chunksize   number of responses converted at a time
+    """
+
+    levels=sorted(levels)
+    fineMeters=levels[0] * 1000
+    accumulators={ resolution:CellAccumulator(resolution * 1000)
+                   for resolution in levels }
+
+    responses=iter(responses)
+    npts=0
+    while True:
+        chunk=list(itertools.islice(responses,chunksize))
+        if not chunk:
+            break
+        npts+=len(chunk)
+        cellids=np.array(getCellIds(chunk,fineMeters),dtype=np.int64)
+        values=cdi.getValueArray(chunk)
+        for resolution,accumulator in accumulators.items():
+            accumulator.add(rollupCellIds(cellids,fineMeters,
+                                          resolution * 1000),values)
+
+    print('Streamed %i entries, aggregating at %s km.' %
+          (npts,'/'.join([ str(x) for x in levels ])))
+    pyramid={}
+    for resolution,accumulator in accumulators.items():
+        pyramid[resolution]=accumulator.features()
+        print('Level %s km: %i pts' % (resolution,len(pyramid[resolution])))
+
+    return pyramid
+
+
+def aggregateGroups(groups,levels=LEVELS,chunksize=CHUNKSIZE):
+    """
+    Same as aggregatePyramid, for responses already summed by location
+    on the database side (see Db.aggiter)
+    Returns a dict of cell size in km: result of aggregate() at that size
+
+    Groups come in order of first response, so cells are in the same
+    order as aggregate() of the raw rows.
+
+    Arguments:
+    groups      iterable of dicts with latitude, longitude, nresp and
+                <index>_sum, <index>_n for each CDI index
+    levels      list of cell sizes in km (default LEVELS)
+    chunksize   number of groups converted at a time
+    """
+
+    levels=sorted(levels)
+    fineMeters=levels[0] * 1000
+    accumulators={ resolution:CellAccumulator(resolution * 1000)
+                   for resolution in levels }
+
+    # Same as Db.row2geojson, which drops rows without lat/lon
+    groups=( g for g in groups if g['latitude'] and g['longitude'] )
+    ngroups=0
+    npts=0
+    while True:
+        chunk=list(itertools.islice(groups,chunksize))
+        if not chunk:
+            break
+        ngroups+=len(chunk)
+        lons=np.array([ g['longitude'] for g in chunk ],dtype=float)
+        lats=np.array([ g['latitude'] for g in chunk ],dtype=float)
+        cellids=np.array(getCellIdsArray(lons,lats,fineMeters),dtype=np.int64)
+        nresp=np.array([ g['nresp'] for g in chunk ],dtype=int)
+        totals=np.array([ [ g[index+'_sum'] or 0 for index in cdi.cdiIndices ]
+                          for g in chunk ],dtype=float)
+        nums=np.array([ [ g[index+'_n'] for index in cdi.cdiIndices ]
+                        for g in chunk ],dtype=float)
+        npts+=int(nresp.sum())
+        for resolution,accumulator in accumulators.items():
+            accumulator.addSums(rollupCellIds(cellids,fineMeters,
+                                              resolution * 1000),
+                                nresp,totals,nums)
+
+    print('Got %i entries in %i locations, aggregating at %s km.' %
+          (npts,ngroups,'/'.join([ str(x) for x in levels ])))
+    pyramid={}
+    for resolution,accumulator in accumulators.items():
+        pyramid[resolution]=accumulator.features()
+        print('Level %s km: %i pts' % (resolution,len(pyramid[resolution])))
+
+    return pyramid
+
+
+class CellAccumulator():
+    """
+Running per-cell sums and counts of the CDI indices, fed in chunks.
+
+Usage:
+    accumulator=CellAccumulator(resolutionMeters)
+    accumulator.add(cellids,values) : cell IDs (see getCellIds, -1 is
+        skipped) and cdi.getValueArray of a chunk of responses
+    accumulator.addSums(cellids,nresp,totals,nums) : same, for groups
+        of responses already summed (see aggregateGroups)
+    results=accumulator.features() : same as aggregate() of all the
+        responses added
+
+    Sums are added in response order (np.add.at), as in aggregate().
+    Cells are kept in order of first response.
+
+    """
+
+    def __init__(self,resolutionMeters):
+        self.resolutionMeters=resolutionMeters
+        self.rows={}            # cell ID: row in the arrays below
+        self.cellids=[]
+        self.nresp=np.zeros(0,dtype=int)
+        self.totals=np.zeros((0,len(cdi.cdiIndices)))
+        self.nums=np.zeros((0,len(cdi.cdiIndices)))
+
+    def __len__(self):
+        return len(self.cellids)
+
+    def add(self,cellids,values):
+        missing=np.isnan(values)
+        self.addSums(cellids,np.ones(len(cellids),dtype=int),
+                     np.where(missing,0,values),~missing)
+
+    def addSums(self,cellids,nresp,totals,nums):
+        keep=cellids>=0
+        cellids,nresp=cellids[keep],nresp[keep]
+        totals,nums=totals[keep],nums[keep]
+        if not len(cellids):
+            return
+
+        ids,first,inverse=np.unique(cellids,return_index=True,
+                                    return_inverse=True)
+        ids=ids.tolist()
+        new=sorted([ (first[n],cellid) for n,cellid in enumerate(ids)
+                     if cellid not in self.rows ])
+        if new:
+            for _,cellid in new:
+                self.rows[cellid]=len(self.cellids)
+                self.cellids.append(cellid)
+            self.nresp=np.concatenate([self.nresp,np.zeros(len(new),int)])
+            zeros=np.zeros((len(new),len(cdi.cdiIndices)))
+            self.totals=np.concatenate([self.totals,zeros])
+            self.nums=np.concatenate([self.nums,zeros])
+
+        rows=np.array([ self.rows[cellid] for cellid in ids ])
+        rows=rows[inverse.ravel()]
+        np.add.at(self.nresp,rows,nresp)
+        np.add.at(self.totals,rows,totals)
+        np.add.at(self.nums,rows,nums)
+
+    def features(self):
+        with np.errstate(invalid='ignore'):
+            means=self.totals / self.nums
+        return getCellFeatures(self.cellids,self.nresp,means,
+                               self.resolutionMeters)
+
+
+def rollupCellIds(cellids,fineMeters,resolutionMeters):
+    """
+    Returns the IDs of the cells of size resolutionMeters that contain
+    these cells of size fineMeters (-1 stays -1)
+    """
+
+    if resolutionMeters==fineMeters:
+        return cellids
+    if resolutionMeters % fineMeters:
+        raise ValueError('cell size %s is not a multiple of %s' %
+                         (resolutionMeters,fineMeters))
+
+    factor=int(resolutionMeters // fineMeters)
+    mask=(1 << CELLBITS)-1
+    zone=cellids >> 2*CELLBITS
+    xi=((cellids >> CELLBITS) & mask) // factor
+    yi=(cellids & mask) // factor
+    ids=zone << 2*CELLBITS | xi << CELLBITS | yi
+    return np.where(cellids>=0,ids,-1)
+
+
+def aggregateCells(cellids,values,resolutionMeters):
+    """
+    Returns the aggregated Features (see aggregate) of responses
+    already assigned to cells
+
+    Arguments:
+    cellids     array of cell IDs of the responses, -1 to skip
+    values      array from cdi.getValueArray
+    """
+
+    keep=cellids>=0
+    cellids,values=cellids[keep],values[keep]
+
+    # Number the cells in order of first response
+    ids,first,cells=np.unique(cellids,return_index=True,return_inverse=True)
+    order=np.argsort(first)
+    rank=np.empty(len(ids),dtype=int)
+    rank[order]=np.arange(len(ids))
+    cells=rank[cells.ravel()]
+
+    nresp=np.bincount(cells,minlength=len(ids))
+    means=cdi.getMeans(values,cells,len(ids))
+    return getCellFeatures(ids[order].tolist(),nresp,means,resolutionMeters)
+
+
+def getCellIds(pts,resolutionMeters):
+    """
+    Returns an array with the integer cell ID of each point,
+    -1 if the point is out of UTM range
+
+    Same cells as getAggregation, without the string keys
+    """
+
+    coords=[ pt['geometry']['coordinates'] for pt in pts ]
+    lons=np.array([ c[0] for c in coords ],dtype=float)
+    lats=np.array([ c[1] for c in coords ],dtype=float)
+    return getCellIdsArray(lons,lats,resolutionMeters)
+
+
+def getCellIdsArray(lons,lats,resolutionMeters):
+    """
+    Same as getCellIds, for arrays of lon/lat
+    """
+
+    x,y,zonenum,zoneletter,valid=from_latlon_array(lats,lons)
+
+    letters=np.searchsorted(ZONELETTERS[:-1],zoneletter)
+    letters[zoneletter=='']=len(ZONELETTERS)-1
+    with np.errstate(invalid='ignore'):
+        xi=np.floor(x/resolutionMeters)
+        yi=np.floor(y/resolutionMeters)
+    xi=np.where(valid,xi,0).astype(np.int64)
+    yi=np.where(valid,yi,0).astype(np.int64)
+
+    cellids=((zonenum.astype(np.int64)*32+letters) << 2*CELLBITS
+             | xi << CELLBITS | yi)
+    return np.where(valid,cellids,-1).tolist()
+
+
+def inOneCell(minlons,minlats,maxlons,maxlats,resolutionMeters,margin=1e-6):
+    """
+    Returns a list of True for the lon/lat boxes that are inside one
+    cell (or all out of UTM range), False for those across a cell edge
+
+    The corners are moved out by margin degrees (about 0.1 m, more than
+    the curvature of a cell edge over the box), so a box whose corners
+    are all in one cell holds no point of another cell.
+    """
+
+    minlons=np.asarray(minlons,dtype=float)-margin
+    minlats=np.asarray(minlats,dtype=float)-margin
+    maxlons=np.asarray(maxlons,dtype=float)+margin
+    maxlats=np.asarray(maxlats,dtype=float)+margin
+    corners=[ getCellIdsArray(lons,lats,resolutionMeters)
+              for lons,lats in [ (minlons,minlats),(maxlons,minlats),
+                                 (minlons,maxlats),(maxlons,maxlats) ] ]
+    return [ len(set(cellids))==1 for cellids in zip(*corners) ]
+
+
+def unpackCellId(cellid,resolutionMeters):
+    """
+    Returns (x0,y0,zonenum,zoneletter) of a cell ID (see getCellIds)
+    """
+
+    mask=(1 << CELLBITS)-1
+    zone,letter=divmod(cellid >> 2*CELLBITS,32)
+    x0=int(((cellid >> CELLBITS) & mask) * resolutionMeters)
+    y0=int((cellid & mask) * resolutionMeters)
+    return x0,y0,zone,ZONELETTERS[letter]
+
+
+def getCellString(cellid,resolutionMeters):
+    """
+    Returns the UTM string of a cell ID, same as getAggregation
+    """
+
+    return '{} {} {} {}'.format(*unpackCellId(cellid,resolutionMeters))
+
+
+def newCell():
+    return {
+        'nresp':0,
+        'totals':dict.fromkeys(cdi.cdiIndices,0),
+        'nums':dict.fromkeys(cdi.cdiIndices,0)
+    }
+
+
+def addValues(cell,values):
+    """
+    Add one response to the running sums and counts of a cell
+
+    Arguments:
+    values      value of each CDI index, NaN if missing
+                (row of cdi.getValueArray)
+    """
+
+    cell['nresp']+=1
+    for index,val in zip(cdi.cdiIndices,values):
+        if math.isnan(val): continue
+        cell['totals'][index]+=val
+        cell['nums'][index]+=1
+
+
+def getCellFeatures(cellids,nresp,means,resolutionMeters):
+    """
+    Returns a list of GeoJSON Point Features (cdi, nresp) at the
+    center of each cell, with the UTM string as id
+
+    Arguments:
+    cellids     list of cell IDs (see getCellIds)
+    nresp       number of responses in each cell
+    means       array (cells x cdi.cdiIndices) of index means
+    """
+
+    if not cellids:
+        return []
+
+    utms=[ getCellString(cellid,resolutionMeters) for cellid in cellids ]
+    centers=getCenters(utms,resolutionMeters)
+    intensities=cdi.getCdiValues(means)
+
     results=[]
-    for loc,pts in rawresults.items():
-        intensity=cdi.calculate(pts)
-                        
-        coords=getCoords(loc,resolutionMeters)
+    for n,utm in enumerate(utms):
         props={
-            'cdi' : intensity,
-            'nresp' : len(pts),
+            'cdi' : intensities[n],
+            'nresp' : int(nresp[n]),
         }
         pt=geojson.Feature(
-            geometry=geojson.Point(coords),
+            geometry=geojson.Point(centers[n]),
             properties=props,
-            id=loc
+            id=utm
         )
         results.append(pt)
 
-    print('Aggregated %i pts into %i pts' % (npts,len(results)))
     return results
 
 
+def getCenters(utms,resolutionMeters):
+    """
+    Returns the (lon,lat) center of each UTM string, same as getCoords
+    Cells not in cellcache are converted in one to_latlon_array call
+    """
+
+    centers=[]
+    missing=[]
+    for n,utm in enumerate(utms):
+        entry=cellcache.get(utm,resolutionMeters)
+        centers.append(entry and entry['center'])
+        if not entry:
+            missing.append(n)
+
+    if missing:
+        cells=[ utms[n].split() for n in missing ]
+        x=np.array([ int(c[0]) for c in cells ])+resolutionMeters/2
+        y=np.array([ int(c[1]) for c in cells ])+resolutionMeters/2
+        lats,lons,valid=to_latlon_array(x,y,[ int(c[2]) for c in cells ],
+                                        [ c[3] for c in cells ])
+        for i,n in enumerate(missing):
+            if not valid[i]:
+                raise OutOfRangeError('cell %s out of range' % utms[n])
+            centers[n]=(round(float(lons[i]),PRECISION),
+                        round(float(lats[i]),PRECISION))
+            cellcache.put(utms[n],resolutionMeters,{ 'center':centers[n] })
+
+    return centers
+
+
+class IncrementalAggregator():
+    """
+Aggregate a moving window of responses without starting over.
+
+Usage:
+    aggregator=IncrementalAggregator(resolution)
+    aggregator.add(responses) : add new responses (FeatureCollection
+        or list of GeoJSON Features, as in aggregate)
+    aggregator.expire(before) : drop the responses with time_now < before
+    results=aggregator.snapshot() : same as aggregate(window,resolution)
+        for the responses added and not expired, in the order added
+    len(aggregator) : number of responses in the window
+
+    Each cell keeps running sums and counts of the cdi.cdiIndices
+    values and the parsed values of its responses. add() only updates
+    the cells of the new responses. expire() rebuilds the sums of the
+    cells that lost responses from the values left, so the results do
+    not depend on the order of adds and expires. snapshot() only
+    recomputes the cells changed since the last snapshot.
+
+    """
+
+    def __init__(self,resolution,timefield='time_now'):
+        self.resolutionMeters=resolution * 1000
+        self.timefield=timefield
+        self.cells={}
+        self.features={}        # cell ID: Feature at the last snapshot
+        self.expiry=[]          # heap of (time,seq,cell ID)
+        self.seq=0
+        self.nresp=0
+
+    def __len__(self):
+        return self.nresp
+
+    def add(self,responses):
+        """
+        Add a FeatureCollection or list of GeoJSON Features
+        Responses out of UTM range are skipped, as in aggregate()
+        """
+
+        if 'features' in responses:
+            responses=responses['features']
+        cellids=getCellIds(responses,self.resolutionMeters)
+        allvalues=cdi.getValueArray(responses).tolist()
+
+        for pt,cellid,values in zip(responses,cellids,allvalues):
+            if cellid<0: continue
+            self.seq+=1
+            t=pt['properties'].get(self.timefield)
+
+            if cellid not in self.cells:
+                self.cells[cellid]=newCell()
+                self.cells[cellid]['responses']=[]
+            cell=self.cells[cellid]
+            addValues(cell,values)
+            cell['responses'].append((self.seq,t,values))
+            self.features.pop(cellid,None)
+            self.nresp+=1
+
+            # Responses without a time never expire
+            if t is not None:
+                heapq.heappush(self.expiry,(t,self.seq,cellid))
+
+    def expire(self,before):
+        """
+        Drop the responses with a time before this one
+        Returns the number of responses dropped
+        """
+
+        changed=set()
+        while self.expiry and self.expiry[0][0]<before:
+            changed.add(heapq.heappop(self.expiry)[2])
+
+        nexpired=0
+        for cellid in changed:
+            responses=[ r for r in self.cells[cellid]['responses']
+                        if r[1] is None or not r[1]<before ]
+            nexpired+=len(self.cells[cellid]['responses'])-len(responses)
+            self.features.pop(cellid,None)
+            if not responses:
+                del self.cells[cellid]
+                continue
+
+            cell=newCell()
+            for r in responses:
+                addValues(cell,r[2])
+            cell['responses']=responses
+            self.cells[cellid]=cell
+
+        self.nresp-=nexpired
+        return nexpired
+
+    def snapshot(self):
+        """
+        Returns the aggregated Features of the current window,
+        see aggregate()
+        """
+
+        changed=[ cellid for cellid in self.cells
+                  if cellid not in self.features ]
+        cells=[ self.cells[cellid] for cellid in changed ]
+        nresp=[ cell['nresp'] for cell in cells ]
+        with np.errstate(invalid='ignore'):
+            means=np.array([[ cell['totals'][index]/cell['nums'][index]
+                              if cell['nums'][index] else np.nan
+                              for index in cdi.cdiIndices ]
+                            for cell in cells ]).reshape(len(cells),-1)
+        features=getCellFeatures(changed,nresp,means,self.resolutionMeters)
+        self.features.update(zip(changed,features))
+
+        # Same order as aggregate(): by first response of each cell
+        cellids=sorted(self.cells,
+                       key=lambda cellid:self.cells[cellid]['responses'][0][0])
+
+        results=[]
+        for cellid in cellids:
+            f=self.features[cellid]
+            results.append(geojson.Feature(
+                geometry=f['geometry'],
+                properties=dict(f['properties']),
+                id=f['id']
+            ))
+        return results
+
+
 def myFloor(x,multiple):
     """ 
     Emulates the math.floor function but
@@ -116,6 +643,10 @@ def getCoords(loc,resolutionMeters):
     Returns a Point object of the center of the UTM location
     
     """
+    entry=cellcache.get(loc,resolutionMeters)
+    if entry:
+        return entry['center']
+
     x,y,zone,zoneletter=loc.split()
     x=int(x)+resolutionMeters/2
     y=int(y)+resolutionMeters/2
@@ -123,6 +654,7 @@ def getCoords(loc,resolutionMeters):
     lat,lon=to_latlon(x,y,zone,zoneletter)
     lat=round(lat,PRECISION)
     lon=round(lon,PRECISION)
+    cellcache.put(loc,resolutionMeters,{ 'center':(lon,lat) })
     return (lon,lat)
 
 
@@ -143,8 +675,15 @@ def getUtmPolyFromString(utm,span):
     bounds    A GeoJSON Polygon object
     ======    ========================
 
+    Results are kept in cellcache.
+
     """
 
+    entry=cellcache.get(utm,span,'bounds')
+    if entry:
+        return ({'center':geojson.Point(entry['center']),
+                 'bounds':geojson.Polygon([entry['bounds']])})
+
     x,y,zone,zoneletter=utm.split()
     x=int(x)
     y=int(y)
@@ -175,12 +714,9 @@ def getUtmPolyFromString(utm,span):
     bounds=geojson.Polygon([[p1,p2,p3,p4,p1]])
 
     # Compute center
-    cx=int(x)+span/2
-    cy=int(y)+span/2
-    clat,clon=to_latlon(cx,cy,zone,zoneletter)
-    clat=round(clat,PRECISION)
-    clon=round(clon,PRECISION)
-    center=geojson.Point((clon,clat))
+    coords=getCoords(utm,span)
+    center=geojson.Point(coords)
+    cellcache.put(utm,span,{ 'center':coords,'bounds':[p1,p2,p3,p4,p1] })
 
     return ({'center':center,'bounds':bounds})
 
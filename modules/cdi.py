@@ -8,46 +8,107 @@ cdi.py :  Take a list of points, combine indices, and calculate CDI
 
 """
 
-import math
+import numpy as np
 
 cdiIndices={'felt':5,'motion':1,'reaction':1,'stand':2,
               'shelf':5,'picture':2,'furniture':3,'damage':5}
 
 def calculate(pts,verbose=False):
+    """
+    Returns the CDI of a list of responses (GeoJSON Features)
+    Single-cell case of getMeans and getCdiValues
+    """
 
-    byindex={} 
-    
-    for index in cdiIndices:
-        total=0
-        num=0
-        for pt in pts:
-            p=pt['properties']
-            if index not in p: continue
-            if p[index] is None: continue
-            val=p[index]
+    values=getValueArray(pts,verbose)
+    means=getMeans(values,np.zeros(len(values),dtype=int),1)
+    return getCdiValues(means)[0]
+
+
+def getValueArray(pts,verbose=False):
+    """
+    Returns an array (responses x cdiIndices) of the numeric value of
+    each CDI index, NaN if missing
+
+    Values already parsed (see modules.db) are used as they are, others
+    go through getValue
+    """
+
+    values=np.full((len(pts),len(cdiIndices)),np.nan)
+    for i,pt in enumerate(pts):
+        p=pt['properties']
+        for j,index in enumerate(cdiIndices):
+            val=p.get(index)
+            if val is None: continue
             if verbose:
               print(index+'='+str(val))
-            try:
-                val=float(val)
-            except:
-                if ' ' in val:
-                    val=val.split(' ')[0]
-                if verbose:
-                    print('CHANGING TO '+val)
-                val=float(val)
-            total+=val
-            num+=1
-        
-        if num: byindex[index]=total/num
-
-    # Now byindex has average of each index
-    cws=0
-    for index in byindex:
-        cws += byindex[index] * cdiIndices[index]
-
-    if cws <= 0 : return 1
-
-    cdi=math.log(cws) * 3.3996 - 4.3781
-    if cdi < 2 : return 2
-    return round(cdi,1)
+            if not isinstance(val,float):
+                val=getValue(val,verbose)
+            values[i,j]=val
+    return values
+
+
+def getMeans(values,cells,ncells):
+    """
+    Returns an array (cells x cdiIndices) of the mean value of each
+    CDI index in each cell, NaN if the cell has no value for it
+
+    Arguments:
+    values      array from getValueArray
+    cells       cell number (0..ncells-1) of each response
+    ncells      number of cells
+    """
+
+    missing=np.isnan(values)
+    means=np.empty((ncells,len(cdiIndices)))
+    with np.errstate(invalid='ignore'):
+        for j in range(len(cdiIndices)):
+            # bincount adds up in response order, like calculate() did
+            totals=np.bincount(cells,np.where(missing[:,j],0,values[:,j]),
+                               ncells)
+            nums=np.bincount(cells,~missing[:,j],ncells)
+            means[:,j]=totals/nums
+    return means
+
+
+def getCdiValues(means):
+    """
+    Returns a list with the CDI of each cell, as Python numbers of the
+    types calculate() always returned (int 1 or 2 if clamped)
+
+    Arguments:
+    means       array (cells x cdiIndices) of index means, NaN if missing
+                (see getMeans)
+    """
+
+    cws,cdi=_cwsCdi(means)
+    rounded=np.round(cdi,1)
+    return [ 1 if c<=0 else 2 if x<2 else float(r)
+             for c,x,r in zip(cws.tolist(),cdi.tolist(),rounded.tolist()) ]
+
+
+def _cwsCdi(means):
+    means=np.atleast_2d(means)
+    cws=np.zeros(len(means))
+    for j,index in enumerate(cdiIndices):
+        cws+=np.where(np.isnan(means[:,j]),0,means[:,j]*cdiIndices[index])
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        cdi=np.log(cws) * 3.3996 - 4.3781
+    return cws,cdi
+
+
+def getValue(val,verbose=False):
+    """
+    Returns the numeric value of one CDI index response
+    (e.g. '1 yes' is 1.0)
+    """
 
+    try:
+        val=float(val)
+    except:
+        if ' ' in val:
+            val=val.split(' ')[0]
+        if verbose:
+            print('CHANGING TO '+val)
+        val=float(val)
+    return val
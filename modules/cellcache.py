@@ -0,0 +1,115 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+cellcache.py : Cache of UTM cell geometry
+
+Keeps the lon/lat center and bounding polygon of UTM cells, keyed by
+(UTM string, cell size in m), so aggregate.py does not need to call
+to_latlon again for cells it has already seen. The set of cells that
+get DYFI responses is small and stable, so the cache can be saved to
+disk and preloaded at startup.
+
+"""
+
+import os
+from collections import OrderedDict
+import numpy as np
+
+MAXSIZE = 100000    # cells kept in memory, least recently used dropped
+
+
+class CellCache():
+    """
+Bounded LRU cache of cell geometry.
+
+Usage:
+    cache=CellCache([maxsize])
+    entry=cache.get(utm,span) : dict with 'center' (lon,lat) and, once
+        computed, 'bounds' (list of (lon,lat)), or None on a miss
+    cache.put(utm,span,entry)
+
+    cache.hits, cache.misses : lookup counters (see cache.stats())
+    cache.save(file), cache.load(file) : store/preload the cache (.npz)
+
+    """
+
+    def __init__(self,maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,utm,span,need='center'):
+        """
+        Returns the entry of this cell, or None if it is not cached or
+        does not have the value need ('center' or 'bounds')
+        """
+
+        entry = self.entries.get((utm,span))
+        if entry is None or need not in entry:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end((utm,span))
+        return entry
+
+    def put(self,utm,span,entry):
+        key = (utm,span)
+        if key in self.entries:
+            self.entries[key].update(entry)
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = dict(entry)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'Cell cache: %i cells, %i hits, %i misses (%.1f%% hits)' % (
+            len(self),self.hits,self.misses,
+            100.0*self.hits/total if total else 0)
+
+    def save(self,file):
+        """
+        Save all cells (least recently used first) as a .npz file
+        """
+
+        keys = list(self.entries)
+        centers = np.full((len(keys),2),np.nan)
+        bounds = np.full((len(keys),5,2),np.nan)
+        for n,key in enumerate(keys):
+            entry = self.entries[key]
+            centers[n] = entry['center']
+            if 'bounds' in entry:
+                bounds[n] = entry['bounds']
+
+        np.savez_compressed(file,
+            utm=np.array([ key[0] for key in keys ],dtype=str),
+            span=np.array([ key[1] for key in keys ],dtype=float),
+            center=centers,bounds=bounds)
+
+    def load(self,file):
+        """
+        Add the cells saved in file, returns the number of cells read
+        (0 if file does not exist)
+        """
+
+        if not os.path.exists(file):
+            return 0
+
+        with np.load(file) as data:
+            for n,utm in enumerate(data['utm'].tolist()):
+                span = data['span'][n].item()
+                entry = { 'center':tuple(data['center'][n].tolist()) }
+                if np.isfinite(data['bounds'][n]).all():
+                    entry['bounds'] = [ tuple(p)
+                                        for p in data['bounds'][n].tolist() ]
+                self.put(utm,span,entry)
+
+            return len(data['utm'])
@@ -4,6 +4,46 @@ import mysql.connector
 import geojson
 import datetime
 import json
+import itertools
+import re
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import modules.cdi as cdi
+import modules.aggregate as aggregate
+
+# Rows read from the cursor at a time by iterquery
+BATCHSIZE=1000
+
+# Connections kept by each shared ConnectionPool (see getpool); extquery
+# queries up to this many tables at once
+POOLSIZE=4
+
+# Opening a connection is retried this many times, waiting BACKOFF
+# seconds, then twice as long each time
+RETRIES=3
+BACKOFF=0.5
+
+# Idle connections are pinged before reuse after this many seconds
+PING_IDLE=30
+
+# Waiting for a free connection raises PoolError after this many seconds
+TIMEOUT=30
+
+# Shared pools, one per database (see getpool)
+pools={}
+
+# aggiter sums the responses of locations rounded to this many decimals,
+# and queries the boxes across a cell edge AGG_BOXES at a time
+AGG_DIGITS=3
+AGG_BOXES=100
+
+# Tables hold one year of time_now each; keep a table if the query
+# window comes this close to its year (time zones, late entries)
+TABLE_MARGIN=datetime.timedelta(days=1)
 
 class Db():
     """
@@ -11,8 +51,10 @@ Interface for connecting to the MySQL database.
 
 Usage:
     from db import Db
-    db=Db([config.yml])
-    results=db.extquery(columns,table,querytext) : 
+    db=Db(dbparams) : dbparams is the db section of config.yml; with
+        fake: true, queries return the rows of tests/testdataset.json
+        instead (no MySQL connection)
+    results=db.extquery(columns,table,querytext,[timerange]) :
         returns extended entries in geojson format.
         columns : column name, or list of columns, or comma-delimited list, or
             all : get all columns
@@ -21,6 +63,15 @@ Usage:
             (blank) : all extended tables
             latest : only the latest extended table
         query : MySQL query text after 'WHERE'
+        timerange : (t0,t1) of time_now, either can be None; tables
+            outside it are skipped. Default: parsed from the query
+            text (see gettimerange). Tables left are queried at the
+            same time over up to db.poolsize connections.
+
+    for feature in db.windowiter(columns,table,t0,[t1],[unknown]) :
+        the standard time window query (time_now>t0 and time_now<t1,
+        optionally only eventid="unknown"), as a prepared statement
+    results=db.windowquery(...) : same, returns a FeatureCollection
 
     results=db.query(columns,table,querytext) :
         simpler version that returns a raw dict.
@@ -28,14 +79,40 @@ Usage:
         table : table name only
         query : MySQL query text after 'WHERE'
 
-    db.connector : ref to MySQL connector
-    db.cursor : ref to MySQL cursor, for making custom queries
+    for feature in db.iterext(columns,table,querytext,[batchsize]) :
+        same as extquery, but yields one feature at a time as rows are
+        read from the cursor (for large result sets)
+    for row in db.iterquery(table,columns,querytext,[batchsize]) :
+        same as query, one raw dict at a time
+    n=db.count(table,querytext) : number of matching rows
+    for row in db.aggiter(table,querytext,[resolution]) :
+        sums of the CDI indices computed by the database, one row per
+        ~100 m box of locations instead of one per response, boxes
+        inside one cell of resolution km (see aggregate.aggregateGroups)
+
+    with db.connection() as connector : a live connection from db.pool
+        for custom queries, given back at the end of the block
+    db.pool : ConnectionPool shared by all Db with the same dbparams;
+        each query takes a connection from it and gives it back (a Db
+        holds none between queries, iterquery/iterext/windowiter hold
+        one until the generator is done or discarded)
+    db.batchsize : rows fetched at a time by iterquery/iterext
+    db.poolsize : connections used by extquery
     db.cdicolumns : list of columns used for calculating CDI
+    db.stats() : query time and pool metrics (time waiting for a
+        connection, reconnects), to tell DB latency from compute time
 
 
     """
 
-    def __init__(self,dbparams):
+    def __init__(self,dbparams,batchsize=BATCHSIZE,poolsize=POOLSIZE):
+
+        self.dbparams=dbparams
+        self.batchsize=batchsize
+        self.poolsize=poolsize
+        self.nqueries=0
+        self.querytime=0.0
+        self.lock=threading.Lock()
 
         self.cdicolumns=['subid','latitude','longitude','felt','other_felt','motion','reaction','stand','shelf','picture','furniture','damage','time_now']
 
@@ -46,20 +123,55 @@ Usage:
             (['pre'] + list(range(EXT_MINYR,EXT_MAXYR+1)))]
         self.latesttable=self.exttables[-1]
 
+        # Years of time_now in each table, None if open-ended
+        self.tablespans={}
+        for table in self.exttables:
+            year=table.split('_')[1]
+            if year=='pre':
+                span=[None,datetime.datetime(EXT_MINYR,1,1)]
+            else:
+                span=[datetime.datetime(int(year),1,1),
+                      datetime.datetime(int(year)+1,1,1)]
+            if table==self.latesttable:
+                span[1]=None
+            self.tablespans[table]=tuple(span)
+
+        # Test data only when asked for; a MySQL connection that still
+        # fails after the retries (see ConnectionPool) raises here
+        if dbparams.get('fake'):
+          print('WARNING: Db using tests/testdataset.json, not MySQL')
+          self.pool=ConnectionPool(FakeConnector,poolsize)
+        else:
+          self.pool=getpool(dbparams,poolsize)
+        with self.connection():
+          pass
+
+    @contextmanager
+    def connection(self):
+        """
+A connection from db.pool for one query, checked first (reconnects if
+it was lost, see ConnectionPool.check) and given back at the end of
+the with block
+
+        """
+
+        connector=self.pool.check(self.pool.acquire())
         try:
-          connector=mysql.connector.connect(
-            user=dbparams['user'],
-            password=dbparams['password'],
-            database=dbparams['database'])
-          self.connector=connector
-          self.cursor=self.connector.cursor(dictionary=True)
-        except:
-          print('WARNING: Db could not open MySQL connection')
-          self.cursor=FakeCursor()
+            yield connector
+        finally:
+            self.pool.release(connector)
 
+    def addtime(self,seconds):
+        with self.lock:
+            self.nqueries+=1
+            self.querytime+=seconds
 
+    def stats(self):
+        text='DB: %i queries, %.2f s in queries.' % (self.nqueries,
+                                                      self.querytime)
+        return text+' '+self.pool.stats()
 
-    def extquery(self,columns,table,text):
+    def extquery(self,columns,table,text,timerange=None):
         """
 The main API function for making extended database queries. Mostly a
 wrapper to query(), but converts output to geojson.
@@ -67,40 +179,275 @@ wrapper to query(), but converts output to geojson.
     columns: single column, list, or comma-delimited string
     table: single table, list, or comma-delimited string
     text: text after WHERE in MySQL query
+    timerange: (t0,t1) of time_now, default parsed from text
+
+Tables that cannot match timerange are skipped. The others are queried
+concurrently, one connection each (up to db.poolsize), and the
+results are put together in table order.
+
+        """
+
+        columns=self.getcolumns(columns)
+        tables=self.gettables(table,timerange or self.gettimerange(text))
+
+        if len(tables)>1 and self.poolsize>1:
+            nworkers=min(self.poolsize,len(tables))
+            print('Querying %i tables over %i connections.' %
+                  (len(tables),nworkers))
+            with ThreadPoolExecutor(max_workers=nworkers) as executor:
+                rows=list(executor.map(
+                    lambda table:self.query(table,columns,text),tables))
+        else:
+            rows=[ self.query(table,columns,text) for table in tables ]
+
+        results=[]
+        for table,tablerows in zip(tables,rows):
+            for rowdata in tablerows:
+                rowgeojson=self.row2geojson(rowdata)
+                if not rowgeojson:
+                    continue
+                rowgeojson['properties']['table']=table
+                results.append(rowgeojson)
+
+        fc=geojson.FeatureCollection(results)
+        print('Done with extquery, returning.')
+        return fc 
+
+    def windowquery(self,columns,table,t0,t1=None,unknown=False):
+        """
+Same as windowiter, returns a FeatureCollection
+
+        """
+
+        fc=geojson.FeatureCollection(list(self.windowiter(
+            columns,table,t0,t1,unknown)))
+        print('Done with windowquery, returning.')
+        return fc
+
+    def windowiter(self,columns,table,t0,t1=None,unknown=False,
+                   batchsize=None):
+        """
+The standard time window query: yields the geojson feature of each
+row with time_now>t0 (and time_now<t1, and eventid="unknown" if
+unknown), like iterext.
+
+The statement is prepared once per connection and table (see
+ConnectionPool.prepared) and reused with the new times on later calls
+(daemon, replay). t0 and t1 are
+datetimes or "YYYY-MM-DD HH:MM:SS" strings.
+
+        """
+
+        columns=self.getcolumns(columns)
+        t0,t1=totime(t0),totime(t1)
+        conditions=['time_now>%s']
+        params=[t0]
+        if t1:
+            conditions.append('time_now<%s')
+            params.append(t1)
+        if unknown:
+            conditions.append('eventid="unknown"')
+        text=' AND '.join(conditions)
+
+        batchsize=batchsize or self.batchsize
+        for table in self.gettables(table,(t0,t1)):
+            statement='SELECT '+columns+' FROM '+table+' WHERE '+text
+            print("Query: "+statement,params)
+            with self.connection() as connector:
+                cursor=self.pool.prepared(connector,statement)
+                done=False
+                try:
+                    t=time.time()
+                    cursor.execute(statement,params)
+                    rows=cursor.fetchmany(batchsize)
+                    self.addtime(time.time()-t)
+                    while rows:
+                        for row in rows:
+                            if not isinstance(row,dict):
+                                row=dict(zip(cursor.column_names,row))
+                            rowgeojson=self.row2geojson(row)
+                            if not rowgeojson:
+                                continue
+                            rowgeojson['properties']['table']=table
+                            yield rowgeojson
+                        t=time.time()
+                        rows=cursor.fetchmany(batchsize)
+                        self.addtime(time.time()-t)
+                    done=True
+                finally:
+                    # Stopped early: the cursor has unread rows, drop it
+                    if not done:
+                        self.pool.unprepare(connector,statement)
+                        discard(cursor)
+
+    def iterext(self,columns,table,text,batchsize=None,timerange=None):
+        """
+Generator version of extquery. Yields the geojson feature of each row
+as it comes from the cursor, so the rows are never all in memory.
+Rows are fetched batchsize at a time (default db.batchsize). Tables
+are skipped as in extquery but read one after the other.
+
+        """
+
+        columns=self.getcolumns(columns)
+        tables=self.gettables(table,timerange or self.gettimerange(text))
+        for table in tables:
+            for rowdata in self.iterquery(table,columns,text,batchsize):
+                rowgeojson=self.row2geojson(rowdata)
+                if not rowgeojson:
+                    continue
+                rowgeojson['properties']['table']=table
+                yield rowgeojson
+
+    def count(self,table,text):
+        """
+Number of rows matching the query text, over all the tables selected
+by table (see extquery).
+
+        """
+
+        total=0
+        for table in self.gettables(table,self.gettimerange(text)):
+            result=self.query(table,'COUNT(*) AS n',text)
+            if result:
+                total+=result[0]['n']
+        return total
 
+    def aggiter(self,table,text,resolution=1):
         """
+Server-side aggregation. Yields rows that each sum the responses of a
+small box of locations (latitude,longitude rounded to AGG_DIGITS
+decimals, about 100 m) inside one cell of resolution km, with the
+columns:
+    latitude, longitude : southwest corner of the box, in the cell
+    maxlat, maxlon : northeast corner
+    nresp       number of responses
+    first       smallest subid, rows come in this order
+    mintime     earliest time_now
+    <index>_sum, <index>_n : sum and number of non-missing values of
+                each CDI index, parsed the way row2geojson does
+                ('1 yes' is 1, '' and 'null' are missing)
+
+A box across a cell edge is queried again by exact location, so the
+cells of aggregate.aggregateGroups are the same as from the raw rows.
+Responses without a location are left out. The rows of each table are
+sorted in memory (there are far fewer than responses). Plain SQL,
+works with MySQL and SQLite; not available with fake: true.
 
+        """
+
+        if self.dbparams.get('fake'):
+            raise RuntimeError('Db.aggiter needs MySQL, the fake: true test '
+                               'data has no server-side aggregation')
+
+        columns=['MIN(latitude) AS latitude','MIN(longitude) AS longitude',
+                 'MAX(latitude) AS maxlat','MAX(longitude) AS maxlon',
+                 'COUNT(*) AS nresp','MIN(subid) AS first',
+                 'MIN(time_now) AS mintime']
+        for index in cdi.cdiIndices:
+            value=('CASE WHEN CAST({0} AS CHAR) IN (\'\',\'null\') '
+                   'THEN NULL ELSE {0}+0 END').format(index)
+            columns.append('SUM({0}) AS {1}_sum'.format(value,index))
+            columns.append('COUNT({0}) AS {1}_n'.format(value,index))
+        columns=','.join(columns)
+
+        timerange=self.gettimerange(text)
+        text='('+text+') AND latitude<>0 AND longitude<>0'
+        key='ROUND(latitude,{0}),ROUND(longitude,{0})'.format(AGG_DIGITS)
+        for table in self.gettables(table,timerange):
+            groups=list(self.iterquery(table,columns,text+' GROUP BY '+key))
+            inside=aggregate.inOneCell(
+                [ g['longitude'] for g in groups ],
+                [ g['latitude'] for g in groups ],
+                [ g['maxlon'] for g in groups ],
+                [ g['maxlat'] for g in groups ],resolution*1000)
+            rows=[ g for g,ok in zip(groups,inside) if ok ]
+
+            # Boxes across a cell edge, by exact location
+            boxes=[ '(latitude BETWEEN {} AND {} AND longitude BETWEEN {} AND {})'
+                    .format(g['latitude'],g['maxlat'],g['longitude'],g['maxlon'])
+                    for g,ok in zip(groups,inside) if not ok ]
+            for i in range(0,len(boxes),AGG_BOXES):
+                boxtext='{} AND ({}) GROUP BY latitude,longitude'.format(
+                    text,' OR '.join(boxes[i:i+AGG_BOXES]))
+                rows+=self.iterquery(table,columns,boxtext)
+
+            for row in sorted(rows,key=lambda row:row['first']):
+                row['table']=table
+                yield row
+
+    def getcolumns(self,columns):
         if not columns or columns=='all':
             columns='*'
         elif not isinstance(columns,str):
             columns=','.join(columns)
         elif columns=='cdi':
             columns=','.join(self.cdicolumns)
+        return columns
 
+    def gettables(self,table,timerange=None):
         if not table or table=='extended' or table=='all':
             tables=self.exttables
         elif table=='latest':
             tables=[self.latesttable]
+        elif not isinstance(table,str):
+            tables=list(table)
         elif ',' in table:
             tables=table.split(',')
         else:
             tables=[table]
 
-        results=[]
-        for table in tables:
-            result=self.query(table,columns,text)
-            if not result:
-                continue
-            for rowdata in result:
-                rowgeojson=self.row2geojson(rowdata)
-                if not rowgeojson:
+        if timerange:
+            tables=[ table for table in tables
+                     if self.intimerange(table,timerange) ]
+        return tables
+
+    def intimerange(self,table,timerange):
+        """
+False if this table cannot have rows with time_now in timerange
+(tables not in db.tablespans are always kept)
+
+        """
+
+        if table not in self.tablespans:
+            return True
+        t0,t1=timerange
+        start,end=self.tablespans[table]
+        if t1 and start and t1<start-TABLE_MARGIN:
+            return False
+        if t0 and end and t0>=end+TABLE_MARGIN:
+            return False
+        return True
+
+    def gettimerange(self,text):
+        """
+Returns (t0,t1) from time_now comparisons in the query text, e.g.
+'time_now>"2019-01-01 00:00:00"', or None if there are none or the
+text has an OR (which could make them optional)
+
+        """
+
+        if re.search(r'\bor\b',text,re.IGNORECASE):
+            return None
+
+        t0=t1=None
+        pattern=r'\btime_now\s*(>=|<=|>|<|=)\s*["\']([^"\']+)["\']'
+        for op,value in re.findall(pattern,text):
+            try:
+                t=datetime.datetime.strptime(value[:19],'%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                try:
+                    t=datetime.datetime.strptime(value[:10],'%Y-%m-%d')
+                except ValueError:
                     continue
-                rowgeojson['properties']['table']=table
-                results.append(rowgeojson)
-      
-        fc=geojson.FeatureCollection(results)
-        print('Done with extquery, returning.')
-        return fc 
+            if op in ('>','>=','='):
+                t0=max(t0,t) if t0 else t
+            if op in ('<','<=','='):
+                t1=min(t1,t) if t1 else t
+
+        if not t0 and not t1:
+            return None
+        return (t0,t1)
 
     def query(self,table,column,text):
         """
@@ -111,6 +458,43 @@ Simpler MySQL query. The parameters table and column must be strings.
         results=self.rawquery(template)
         return results
 
+    def iterquery(self,table,column,text,batchsize=None):
+        """
+Generator version of query(), yields one row at a time.
+
+Rows are read with fetchmany, batchsize at a time (default
+db.batchsize), from a separate unbuffered cursor, so the first rows
+are available before the query has finished and the rest stay on the
+server until needed. The cursor is closed when the generator is done
+or discarded; stopping early reads and drops the rows left (see
+discard), so the connection stays usable.
+
+        """
+        template='SELECT '+column+' FROM '+table+' WHERE '+text
+        print("Query: "+template)
+
+        batchsize=batchsize or self.batchsize
+        with self.connection() as connector:
+            cursor=connector.cursor(dictionary=True,buffered=False)
+            done=False
+            try:
+                t=time.time()
+                cursor.execute(template)
+                rows=cursor.fetchmany(batchsize)
+                self.addtime(time.time()-t)
+                while rows:
+                    for row in rows:
+                        yield row
+                    t=time.time()
+                    rows=cursor.fetchmany(batchsize)
+                    self.addtime(time.time()-t)
+                done=True
+            finally:
+                if done:
+                    cursor.close()
+                else:
+                    discard(cursor)
+
     def rawquery(self,text):
         """
 Simplest MySQL query with the raw query string, no formatting.
@@ -118,8 +502,13 @@ Simplest MySQL query with the raw query string, no formatting.
         """
         print("Query: "+text)
 
-        self.cursor.execute(text)
-        results=self.cursor.fetchall()
+        with self.connection() as connector:
+            t=time.time()
+            cursor=connector.cursor(dictionary=True)
+            cursor.execute(text)
+            results=cursor.fetchall()
+            cursor.close()
+            self.addtime(time.time()-t)
         return results
 
     def timedelta(self,t,t0=None):
@@ -152,6 +541,13 @@ Simplest MySQL query with the raw query string, no formatting.
                 continue
             if val=='null' or val=='': 
                 val=None
+
+            # Parse the CDI index values once, here (see cdi.getValue)
+            if key in cdi.cdiIndices and val is not None:
+                try:
+                    val=cdi.getValue(val)
+                except ValueError:
+                    pass
             props[key]=val
         feature=geojson.Feature(geometry=pt,properties=props)
         return(feature)
@@ -164,14 +560,255 @@ Simplest MySQL query with the raw query string, no formatting.
             return serial
 
 
+def discard(cursor):
+    """
+Close a cursor that may still have unread rows (the consumer of
+iterquery or windowiter stopped early or raised). An unbuffered MySQL
+cursor raises when closed before its rows are read, so they are read
+and dropped first. Errors are not raised, not to hide the one that
+stopped the consumer; a connection left broken is replaced when it is
+next checked (see Db.connection).
+
+    """
+
+    try:
+        cursor.fetchall()
+    except Exception as e:
+        print('WARNING: could not read the rest of the query (%s)' % e)
+    try:
+        cursor.close()
+    except Exception as e:
+        print('WARNING: could not close the cursor (%s)' % e)
+
+
+def totime(t):
+    if isinstance(t,str):
+        return datetime.datetime.strptime(t,'%Y-%m-%d %H:%M:%S')
+    return t
+
+
+def getpool(dbparams,size=POOLSIZE):
+    """
+Returns the ConnectionPool of this database, shared by all Db in this
+process (created on first use, grown to size if needed)
+
+    """
+
+    key=tuple(sorted((k,str(v)) for k,v in dbparams.items()))
+    if key not in pools:
+        def connect():
+            return mysql.connector.connect(
+                user=dbparams['user'],
+                password=dbparams['password'],
+                database=dbparams['database'])
+        pools[key]=ConnectionPool(connect,size)
+    pools[key].size=max(pools[key].size,size)
+    return pools[key]
+
+
+class ConnectionPool():
+    """
+Connections to one database, opened when needed and reused.
+
+Usage:
+    pool=ConnectionPool(connect,[size]) : connect() opens a connection
+    connector=pool.acquire() : idle connection (pinged first if it was
+        idle for PING_IDLE s) or a new one; if size are in use, waits
+        for one up to timeout s, then raises PoolError
+    pool.release(connector)
+    with pool.connection() as connector : acquire and release
+    connector=pool.check(connector) : same connector if alive, else a
+        new one
+    cursor=pool.prepared(connector,statement) : prepared cursor of the
+        statement on this connection, kept for reuse
+    pool.unprepare(connector,statement) : forget it (cursor left unread)
+
+    New connections are retried RETRIES times with exponential backoff.
+    Metrics (see pool.stats()): acquires, waittime and maxwait (s spent
+    waiting in acquire), connects, reconnects, failures.
+
+    """
+
+    def __init__(self,connect,size=POOLSIZE,retries=RETRIES,backoff=BACKOFF,
+                 timeout=TIMEOUT):
+        self.connect=connect
+        self.size=size
+        self.retries=retries
+        self.backoff=backoff
+        self.timeout=timeout
+        self.idle=queue.LifoQueue()
+        self.lastused={}        # id(connector): time released
+        self.statements={}      # id(connector): {statement: cursor}
+        self.nopen=0
+        self.lock=threading.Lock()
+
+        self.acquires=0
+        self.waittime=0.0
+        self.maxwait=0.0
+        self.connects=0
+        self.reconnects=0
+        self.failures=0
+
+    def acquire(self):
+        t=time.time()
+        while True:
+            try:
+                connector=self.idle.get_nowait()
+                break
+            except queue.Empty:
+                pass
+
+            with self.lock:
+                if self.nopen<self.size:
+                    self.nopen+=1
+                    new=True
+                else:
+                    new=False
+            if new:
+                try:
+                    connector=self.open()
+                except Exception:
+                    with self.lock:
+                        self.nopen-=1
+                    raise
+                break
+
+            # All in use: wait for one, a second at a time in case one
+            # is closed instead of given back
+            left=t+self.timeout-time.time()
+            if left<=0:
+                raise mysql.connector.errors.PoolError(
+                    'No free connection after %.0f s (%i in use)' %
+                    (self.timeout,self.nopen))
+            try:
+                connector=self.idle.get(timeout=min(left,1.0))
+                break
+            except queue.Empty:
+                pass
+
+        if time.time()-self.lastused.get(id(connector),t)>PING_IDLE:
+            connector=self.check(connector)
+
+        wait=time.time()-t
+        with self.lock:
+            self.acquires+=1
+            self.waittime+=wait
+            self.maxwait=max(self.maxwait,wait)
+        return connector
+
+    def release(self,connector):
+        self.lastused[id(connector)]=time.time()
+        self.idle.put(connector)
+
+    @contextmanager
+    def connection(self):
+        connector=self.acquire()
+        try:
+            yield connector
+        finally:
+            self.release(connector)
+
+    def prepared(self,connector,statement):
+        cursors=self.statements.setdefault(id(connector),{})
+        if statement not in cursors:
+            cursors[statement]=connector.cursor(prepared=True)
+        return cursors[statement]
+
+    def unprepare(self,connector,statement):
+        self.statements.get(id(connector),{}).pop(statement,None)
+
+    def open(self):
+        """
+New connection, retried with exponential backoff
+        """
+
+        delay=self.backoff
+        for attempt in range(self.retries+1):
+            try:
+                connector=self.connect()
+                self.connects+=1
+                return connector
+            except Exception as e:
+                self.failures+=1
+                if attempt==self.retries:
+                    raise
+                print('WARNING: connection failed (%s), retrying in %.1f s' %
+                      (e,delay))
+                time.sleep(delay)
+                delay*=2
+
+    def check(self,connector):
+        """
+Returns connector if it is alive, or a new connection
+        """
+
+        try:
+            if connector.is_connected():
+                return connector
+        except Exception:
+            pass
+
+        print('WARNING: lost database connection, reconnecting.')
+        self.lastused.pop(id(connector),None)
+        self.statements.pop(id(connector),None)
+        try:
+            connector.close()
+        except Exception:
+            pass
+        try:
+            connector=self.open()
+        except Exception:
+            with self.lock:
+                self.nopen-=1
+            raise
+        self.reconnects+=1
+        return connector
+
+    def stats(self):
+        return ('Pool: %i/%i open, %i acquires, %.3f s waiting (max %.3f s), '
+                '%i connects, %i reconnects, %i failures.' % (
+                self.nopen,self.size,self.acquires,self.waittime,
+                self.maxwait,self.connects,self.reconnects,self.failures))
+
+    def close(self):
+        """
+Close the idle connections
+        """
+
+        while True:
+            try:
+                connector=self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.lastused.pop(id(connector),None)
+            self.statements.pop(id(connector),None)
+            connector.close()
+            with self.lock:
+                self.nopen-=1
+
+
+class FakeConnector():
+    # Stands in for the MySQL connector, with FakeCursor cursors
+
+    def cursor(self,**kwargs):
+        return FakeCursor()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
 class FakeCursor():
         # Create an object that knows the execute and fetchAll methods
 
     def __init__(self):
         self.data=[]
+        self.rows=iter(self.data)
 
 
-    def execute(self,text):
+    def execute(self,text,params=None):
         try:
           with open('tests/testdataset.json','r') as f:
             data=json.load(f)
@@ -185,10 +822,23 @@ class FakeCursor():
         for e in self.data:
             e['time_now']=datetime.datetime.strptime(e['time_now'],f)
 
+        if text.startswith('SELECT COUNT(*) AS n '):
+            self.data=[{'n':len(self.data)}]
+        self.rows=iter(self.data)
+
 
     def fetchall(self):
         return self.data
 
+    def fetchone(self):
+        return next(self.rows,None)
+
+    def fetchmany(self,size=1):
+        return list(itertools.islice(self.rows,size))
+
+    def close(self):
+        self.rows=iter([])
+
 
 if __name__=='__main__':
     import argparse
@@ -210,8 +860,7 @@ if __name__=='__main__':
         table='all'
         if isinstance(args.extended,str):
             table=args.extended
-        results=db.extquery('*',table,args.query)
-        for row in results:
+        for row in db.iterext('*',table,args.query):
             print(row.properties['table']+':'+str(row.properties['subid']))
         exit()
 
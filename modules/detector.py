@@ -0,0 +1,230 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+detector.py : Response-rate anomaly detector
+
+Cheap gate in front of aggregate/locate. A RateIndex holds the
+background response rate of each UTM cell (long-term average, built
+from the historic extended tables). The responses of the current
+window give a short-term rate per cell; a cell is anomalous when the
+ratio of the two (STA/LTA) is high and the count is unlikely under
+the background rate (Poisson tail probability).
+
+The index is a compact .npz (packed cell IDs, see aggregate.getCellIds,
+and float32 counts) and can be updated with new periods without
+rebuilding it.
+
+"""
+
+import math
+import itertools
+import numpy as np
+
+import modules.aggregate as aggregate
+
+RESOLUTION = 20     # km, cell size of the index
+MINRATE = 0.01      # responses per hour, floor of the background rate
+RATIO = 10          # minimum STA/LTA ratio of an anomalous cell
+MINCOUNT = 5        # minimum responses of an anomalous cell in the window
+MAXPROB = 1e-4      # maximum Poisson tail probability of an anomalous cell
+
+
+class RateIndex():
+    """
+Background response rate of each cell.
+
+Usage:
+    index=RateIndex([resolution])  or  index=RateIndex.load(file)
+    index.update(responses,hours) : add the responses of a period
+    anomalies=index.detect(responses,hours) : anomalous cells of a
+        window of this many hours, see detect()
+    index.save(file)
+
+    responses is any iterable of GeoJSON Features (e.g. Db.iterext),
+    read once.
+
+    """
+
+    def __init__(self,resolution=RESOLUTION):
+        self.resolution = resolution
+        self.counts = {}        # cell ID: number of responses
+        self.hours = 0.0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self,responses,hours,decay=1.0):
+        """
+        Add the responses of a period of this many hours
+        With decay<1, the counts so far are scaled by it first, so
+        older periods count less
+        """
+
+        if decay != 1.0:
+            self.hours *= decay
+            for cellid in self.counts:
+                self.counts[cellid] *= decay
+
+        for cellid,n in countCells(responses,self.resolution).items():
+            self.counts[cellid] = self.counts.get(cellid,0) + n
+        self.hours += hours
+
+    def rate(self,cellid):
+        """
+        Background rate of a cell in responses per hour (at least MINRATE)
+        """
+
+        if not self.hours:
+            return MINRATE
+        return max(self.counts.get(cellid,0) / self.hours,MINRATE)
+
+    def detect(self,responses,hours,ratio=RATIO,mincount=MINCOUNT,
+               maxprob=MAXPROB):
+        """
+        Returns the anomalous cells of a window of responses, as a list
+        of dicts sorted by decreasing ratio:
+            utm         UTM string of the cell
+            n           responses in the window
+            expected    responses expected from the background rate
+            ratio       n / expected (STA/LTA)
+            prob        probability of at least n responses
+        """
+
+        anomalies = []
+        resolutionMeters = self.resolution * 1000
+        for cellid,n in countCells(responses,self.resolution).items():
+            expected = self.rate(cellid) * hours
+            if n < mincount or n < ratio * expected:
+                continue
+            prob = poissonTail(n,expected)
+            if prob > maxprob:
+                continue
+            anomalies.append({
+                'utm' : aggregate.getCellString(cellid,resolutionMeters),
+                'n' : n,
+                'expected' : round(expected,4),
+                'ratio' : round(n / expected,1) if expected else math.inf,
+                'prob' : prob
+            })
+
+        return sorted(anomalies,key=lambda x:x['ratio'],reverse=True)
+
+    def save(self,file):
+        cellids = list(self.counts)
+        np.savez_compressed(file,
+            resolution=self.resolution,hours=self.hours,
+            cellids=np.array(cellids,dtype=np.int64),
+            counts=np.array([ self.counts[c] for c in cellids ],
+                            dtype=np.float32))
+
+    @classmethod
+    def load(cls,file):
+        with np.load(file) as data:
+            index = cls(data['resolution'].item())
+            index.hours = float(data['hours'])
+            index.counts = dict(zip(data['cellids'].tolist(),
+                                    data['counts'].astype(float).tolist()))
+        return index
+
+
+def countCells(responses,resolution,chunksize=aggregate.CHUNKSIZE):
+    """
+    Returns a dict of cell ID: number of responses, for cells of
+    resolution km (responses out of UTM range are skipped)
+    """
+
+    resolutionMeters = resolution * 1000
+    counts = {}
+    responses = iter(responses)
+    while True:
+        chunk = list(itertools.islice(responses,chunksize))
+        if not chunk:
+            break
+        cellids = np.array(aggregate.getCellIds(chunk,resolutionMeters))
+        cellids,n = np.unique(cellids[cellids >= 0],return_counts=True)
+        for cellid,count in zip(cellids.tolist(),n.tolist()):
+            counts[cellid] = counts.get(cellid,0) + count
+
+    return counts
+
+
+def poissonTail(n,expected):
+    """
+    Probability of at least n events when expected are expected
+    """
+
+    if n <= 0:
+        return 1.0
+    if expected <= 0:
+        return 0.0
+
+    # Sum the terms from n up; they decrease once k > expected
+    logterm = -expected + n*math.log(expected) - math.lgamma(n + 1)
+    total = 0.0
+    k = n
+    while True:
+        term = math.exp(logterm)
+        total += term
+        k += 1
+        logterm += math.log(expected / k)
+        if k > expected and term < 1e-12 * total or k > n + 10000:
+            break
+
+    return min(total,1.0)
+
+
+if __name__=='__main__':
+    import argparse
+    import datetime
+    from modules.config import Config
+    from modules.db import Db
+
+    parser=argparse.ArgumentParser(
+        description='Build or update the background response-rate index.'
+    )
+    parser.add_argument('file',type=str,
+        help='Index file (.npz)')
+    parser.add_argument('--tables',type=str,
+        help='Extended tables to read (default all)')
+    parser.add_argument('--start',type=str,
+        help='Only read responses after this time ("2019-01-01 00:00:00")')
+    parser.add_argument('--update',action='store_true',
+        help='Add to the existing index instead of starting over '
+             '(needs --tables or --start, not to count responses twice)')
+    parser.add_argument('--decay',type=float,default=1.0,
+        help='Scale the existing counts by this before updating')
+    parser.add_argument('--resolution',type=int,default=RESOLUTION,
+        help='Cell size in km of a new index')
+    args=parser.parse_args()
+    if args.update and not args.tables and not args.start:
+        parser.error('--update needs --tables or --start')
+
+    db=Db(Config().db)
+    index=RateIndex.load(args.file) if args.update else RateIndex(args.resolution)
+    querytext='time_now>"{}"'.format(args.start) if args.start else '1'
+
+    # Decay the existing counts once, not once per table
+    index.update([],0,args.decay)
+
+    for table in db.gettables(args.tables):
+        span={ 'n':0,'t0':None,'t1':None }
+        def responses():
+            for feature in db.iterext('latitude,longitude,time_now',table,
+                                      querytext):
+                t=feature['properties']['time_now']
+                span['n']+=1
+                if span['t0'] is None or t<span['t0']:
+                    span['t0']=t
+                if span['t1'] is None or t>span['t1']:
+                    span['t1']=t
+                yield feature
+
+        index.update(responses(),0)
+        if span['n']:
+            hours=(span['t1']-span['t0'])/datetime.timedelta(hours=1)
+            index.hours+=hours
+            print('%s: %i responses over %.1f hours' % (table,span['n'],hours))
+
+    index.save(args.file)
+    print('Saved %i cells, %.1f hours to %s' % (len(index),index.hours,args.file))
@@ -0,0 +1,522 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+NumPy grid-search engine for locate_dyfi
+
+Evaluates every trial epicenter of a grid in one batched operation:
+the trial x observation distance/weight matrix is built at once and
+the magnitude/residual of each trial epicenter is computed from it.
+
+This gives the same results as locate_dyfi.loopGrid (the 'python'
+backend) within rounding tolerance.
+
+"""
+
+import math
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from geojson import Point,Feature
+
+from modules import ipes
+from modules import spatial
+from modules.spatial import EARTH_RADIUS
+
+PRECISION = 4
+MAXMAG = 8.1        # Trial magnitudes above this are ignored (type B)
+FLATWT_DIST = 150   # km, observations at least this far get weight 0.1
+
+
+class GridSearch():
+    """
+Grid-search engine for one set of observations.
+
+Usage:
+    engine=GridSearch(ipe,obs,residtype,magrange)
+    bestloc=engine.loopGrid(initloc,gridstep,gridsize,surface)
+    engine.close()
+
+    ipe         IPE function with an array version (see modules.ipes)
+    obs         Observations (see modules.observations)
+    residtype   'A' or 'B' (see locate_dyfi.RESID_TYPE)
+    magrange    list of trial magnitudes (residual type A only)
+    table       IpeTable used for the magnitude scan (optional, type A)
+    solver      'scan' or 'solve' (best magnitude for type A, see
+                trylocation_A_solve)
+    workers     number of worker processes (1 = evaluate in this process)
+    farfield    size in km of the far-field groups (0 = no grouping)
+
+    With farfield set, observations that are at least FLATWT_DIST from
+    every trial epicenter of a grid (so their weight is 0.1 everywhere)
+    are grouped by spatial index cube and intensity. Each group is
+    evaluated once, at its centroid, and counts for all its members.
+    The distance error is at most the group span (engine.farfieldstats
+    has the largest value used); farFieldError() gives the exact
+    magnitude and residual at a location and the error of the grouping.
+
+    With workers>1, each grid is split into chunks of trial epicenters
+    that are evaluated in a process pool. The workers get the engine
+    (observation arrays and settings) when they are forked, see
+    _worker; where processes are not forked, it is sent with each
+    chunk. Chunk results are put back in grid order, so the best
+    location is the same as with a single process.
+
+    """
+
+    def __init__(self,ipe,obs,residtype,magrange,table=None,solver='scan',
+                 workers=1,farfield=0):
+
+        self.ipe = ipe
+        self.obslons,self.obslats,self.cdis = obs.lon,obs.lat,obs.cdi
+        self.obstrig = getTrig(self.obslons,self.obslats)
+
+        # Observations standing for more than one (see Observations.weight)
+        self.weights = None
+        if (obs.weight != 1).any():
+            self.weights = obs.weight
+        self.residtype = residtype
+        self.magrange = magrange
+        self.table = table
+        self.solver = solver
+        self.workers = workers
+        self.pool = None
+
+        self.index = None
+        self.farfieldstats = { 'nfar':0,'ngroups':0,'maxdisterror':0.0 }
+        self.subset = None
+        if farfield:
+            self.index = spatial.SpatialIndex(self.obslons,self.obslats,
+                                              farfield)
+            self.grouplabels = self.index.groups(self.cdis)
+
+        if workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def __getstate__(self):
+        # The pool stays in the parent process
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    def loopGrid(self,initloc,gridstep,gridsize,surface):
+        """
+        Evaluate a (2*gridsize+1)**2 grid of trial epicenters around initloc
+        Returns GeoJSON Feature: best trial epicenter with mag, resid, ix, iy
+
+        Arguments:
+        initloc     grid center, GeoJSON Feature
+        gridstep    grid spacing in km
+        gridsize    number of grid steps on each side of initloc
+        surface     ResidualSurface, the grid results are added to it
+        """
+
+        ixs,iys = getGridOffsets(gridstep,gridsize)
+        trylons,trylats = getOffsetPts(initloc,ixs,iys)
+
+        if self.index:
+            self.subset = self.getFarField(initloc,gridstep*gridsize)
+
+        if self.pool:
+            # Worker processes start on the first map and fork from here
+            global _worker
+            _worker = self
+            engine = None if multiprocessing.get_start_method() == 'fork' \
+                     else self
+            chunks = [ (lons,lats,self.subset,engine) for lons,lats in
+                       zip(np.array_split(trylons,self.workers),
+                           np.array_split(trylats,self.workers)) ]
+            results = list(self.pool.map(_evaluateChunk,chunks))
+            mags = np.concatenate([ r[0] for r in results ])
+            resids = np.concatenate([ r[1] for r in results ])
+        else:
+            mags,resids = self.evaluate(trylons,trylats,self.subset)
+
+        surface.addGrid(initloc['geometry']['coordinates'],gridstep,gridsize,
+                        trylons,trylats,mags,resids)
+
+        # np.argmin returns the first minimum, the same trial epicenter
+        # the python backend keeps (strict comparison in grid order)
+        bestloc = initloc
+        if np.isfinite(resids).any():
+            best = int(np.argmin(resids))
+            bestloc = Feature(
+                geometry=Point((float(trylons[best]),float(trylats[best]))),
+                properties={
+                    'mag' : float(mags[best]),
+                    'resid' : float(resids[best]),
+                    'ix' : int(ixs[best]), 'iy' : int(iys[best])
+                })
+
+        return bestloc
+
+    def evaluate(self,trylons,trylats,subset=None):
+        """
+        Returns (mag,resid) arrays for these trial epicenters
+        If subset is set (see getFarField), use the near-field
+        observations and the far-field groups instead of all observations
+        """
+
+        if subset:
+            near,farlons,farlats,farcdis,farcounts = subset
+            obslons = np.concatenate([self.obslons[near],farlons])
+            obslats = np.concatenate([self.obslats[near],farlats])
+            cdis = np.concatenate([self.cdis[near],farcdis])
+            nearcounts = (np.ones(len(near)) if self.weights is None
+                          else self.weights[near])
+            counts = np.concatenate([nearcounts,farcounts])
+            fartrig = getTrig(farlons,farlats)
+            obstrig = [ np.concatenate([x[near],y])
+                        for x,y in zip(self.obstrig,fartrig) ]
+        else:
+            obslons,obslats,cdis,counts = (self.obslons,self.obslats,
+                                           self.cdis,1)
+            if self.weights is not None:
+                counts = self.weights
+            obstrig = self.obstrig
+
+        dists,wts = getDistancesWts(trylons,trylats,obslons,obslats,obstrig)
+        if self.residtype == 'A' and self.solver == 'solve':
+            return trylocation_A_solve(self.ipe,cdis,dists,wts,
+                                       self.magrange,counts)
+        elif self.residtype == 'A':
+            return trylocation_A(self.ipe,cdis,dists,wts,
+                                 self.magrange,self.table,counts)
+        else:
+            return trylocation_B(self.ipe,cdis,dists,wts,counts)
+
+    def getFarField(self,center,radius):
+        """
+        Group the observations that are far-field for every trial
+        epicenter within radius km of center
+        Returns (near,farlons,farlats,farcdis,farcounts), or None if
+        grouping does not reduce the number of observations
+
+        near        indices of the observations evaluated exactly
+        far*        centroid, intensity and size of each far-field group
+        """
+
+        lon0,lat0 = center['geometry']['coordinates']
+        dists,wts = getDistancesWts([lon0],[lat0],self.obslons,self.obslats,
+                                    self.obstrig)
+
+        # Trial epicenters are at most radius*sqrt(2) from the center and
+        # group centroids at most maxspan from their members
+        mindist = FLATWT_DIST + radius*math.sqrt(2) + self.index.maxspan
+        far = dists[0] >= mindist
+        if not far.any():
+            return None
+
+        groups,members = np.unique(self.grouplabels[far],return_inverse=True)
+        members = members.ravel()
+        if len(groups) >= far.sum():
+            return None
+
+        xyz = self.index.xyz[far]
+        sums = np.zeros((len(groups),3))
+        np.add.at(sums,members,xyz)
+        farlons,farlats = spatial.toLonLat(sums)
+        farlons = np.round(farlons,PRECISION)
+        farlats = np.round(farlats,PRECISION)
+        farweights = None if self.weights is None else self.weights[far]
+        farcounts = np.bincount(members,farweights,len(groups)).astype(float)
+        farcdis = np.zeros(len(groups))
+        farcdis[members] = self.cdis[far]
+
+        # Distance error bound: largest distance of a member to its centroid
+        centroids = spatial.toXyz(farlons,farlats)[members]
+        chords = np.sqrt(((xyz - centroids)**2).sum(axis=1))
+        maxdisterror = spatial.arc(float(chords.max()))
+
+        stats = self.farfieldstats
+        stats['nfar'] = max(stats['nfar'],int(far.sum()))
+        stats['ngroups'] = max(stats['ngroups'],len(groups))
+        stats['maxdisterror'] = max(stats['maxdisterror'],
+                                    round(maxdisterror,PRECISION))
+
+        near = np.nonzero(~far)[0]
+        return (near,farlons,farlats,farcdis,farcounts)
+
+    def farFieldError(self,loc):
+        """
+        Returns the exact magnitude and residual at this location (all
+        observations) and the errors of the far-field grouping of the
+        last grid, as a dict (mag, resid: exact; dmag, dresid: grouped
+        minus exact)
+        """
+
+        lon,lat = loc['geometry']['coordinates']
+        exactmag,exactresid = self.evaluate([lon],[lat])
+        mag,resid = self.evaluate([lon],[lat],self.subset)
+        return {
+            'mag' : float(exactmag[0]),
+            'resid' : float(exactresid[0]),
+            'dmag' : round(float(mag[0] - exactmag[0]),2),
+            'dresid' : round(float(resid[0] - exactresid[0]),PRECISION)
+        }
+
+
+# GridSearch of the worker processes, inherited when they are forked
+_worker = None
+
+def _evaluateChunk(chunk):
+    trylons,trylats,subset,engine = chunk
+    return (engine or _worker).evaluate(trylons,trylats,subset)
+
+
+# Grid offsets already built in this process, by (gridstep,gridsize)
+_offsets = {}
+
+def getGridOffsets(gridstep,gridsize=10):
+    """
+    Returns (ix,iy) arrays of grid offsets in km, in the same order
+    as the python backend (x outer loop, y inner loop)
+    The arrays are shared between calls and are read-only
+    """
+
+    key = (gridstep,gridsize)
+    if key not in _offsets:
+        steps = np.arange(-gridsize,gridsize+1) * gridstep
+        ixs,iys = np.meshgrid(steps,steps,indexing='ij')
+        ixs,iys = ixs.ravel(),iys.ravel()
+        ixs.flags.writeable = False
+        iys.flags.writeable = False
+        _offsets[key] = (ixs,iys)
+
+    return _offsets[key]
+
+
+def getOffsetPts(initloc,ixs,iys):
+    """
+    Vectorized version of locate_dyfi.getOffsetPt
+    Returns (lon,lat) arrays of trial epicenters
+
+    Arguments:
+    initloc     initial point in GeoJSON format (dict)
+    ixs         array of x-offsets in km (positive is East)
+    iys         array of y-offsets in km (positive is North)
+    """
+
+    lat0 = initloc['geometry']['coordinates'][1]
+    lon0 = initloc['geometry']['coordinates'][0]
+    lats = lat0 + (iys / 111.12)
+    lons = lon0 + (ixs / 111.12) * np.cos(lats * 0.0174532925)
+    return np.round(lons,PRECISION),np.round(lats,PRECISION)
+
+
+def getTrig(lons,lats):
+    """
+    Returns (lon in radians, sin(lat), cos(lat)) arrays for these points,
+    see getDistancesWts
+    """
+
+    lats = np.radians(lats)
+    return np.radians(lons),np.sin(lats),np.cos(lats)
+
+
+def getDistancesWts(trylons,trylats,obslons,obslats,obstrig=None):
+    """
+    Vectorized version of locate_dyfi.getDistancesWts
+    Returns (dist,wt) matrices of shape (trials,observations)
+    Uses the same great-circle formula as geopy.distance.great_circle
+    obstrig is getTrig(obslons,obslats), if already computed
+    """
+
+    if obstrig is None:
+        obstrig = getTrig(obslons,obslats)
+    lon2,sin_lat2,cos_lat2 = [ x[np.newaxis,:] for x in obstrig ]
+
+    lat1 = np.radians(trylats)[:,np.newaxis]
+    lon1 = np.radians(trylons)[:,np.newaxis]
+    sin_lat1,cos_lat1 = np.sin(lat1),np.cos(lat1)
+    delta_lon = lon2 - lon1
+    cos_delta_lon,sin_delta_lon = np.cos(delta_lon),np.sin(delta_lon)
+
+    d = np.arctan2(
+        np.sqrt((cos_lat2 * sin_delta_lon)**2 +
+            (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon)**2),
+        sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon)
+    dists = EARTH_RADIUS * d
+
+    wts = np.where(dists >= FLATWT_DIST,0.1,
+                   0.1 + np.cos(math.pi/2*dists/FLATWT_DIST))
+    return np.round(dists,PRECISION),np.round(wts,PRECISION)
+
+
+def trylocation_A(ipe,cdis,dists,wts,magrange,table=None,counts=1):
+    """
+    Vectorized version of locate_dyfi.trylocation_A
+    Returns (mag,resid) arrays, one value per trial epicenter
+    If table (see modules.ipetable) is set, intensities are interpolated
+    from it instead of computed by the IPE
+    counts is the number of observations each column stands for
+    """
+
+    if table:
+        lookup = table.lookup(dists)
+
+    totalwt2 = (counts * wts**2).sum(axis=1)
+    wts = counts * wts
+
+    bestresid2 = np.full(dists.shape[0],9999.0)
+    bestmags = np.zeros(dists.shape[0])
+    for trymag in magrange:
+        if table:
+            tryii = table.evaluate(trymag,lookup)
+        else:
+            tryii = ipe.array(trymag,dists,False)
+        totalresid2 = (wts * (cdis - tryii)**2).sum(axis=1) / totalwt2
+        better = totalresid2 < bestresid2
+        bestmags[better] = trymag
+        bestresid2[better] = totalresid2[better]
+
+    resids = np.round(np.sqrt(bestresid2),PRECISION)
+    return bestmags,resids
+
+
+def trylocation_A_solve(ipe,cdis,dists,wts,magrange,counts=1):
+    """
+    Same as trylocation_A, but solves for the best continuous magnitude
+    instead of scanning magrange
+    Returns (mag,resid) arrays, one value per trial epicenter
+
+    Unclamped, the AWW2014 intensity is linear in magnitude:
+    ii = a + b*mag (b > 0). Each observation is clamped to 1.0 below
+    mag1 = (1-a)/b, to 2.0 between mag1 and mag2 = (2-a)/b, and linear
+    above mag2. Between two consecutive breakpoints (over all
+    observations) the squared residual is therefore a quadratic in
+    magnitude, whose minimum is found directly. The best of these
+    minima (within magrange) is the best magnitude.
+
+    counts is the number of observations each column stands for
+    """
+
+    a = ipe.array(0,dists,False,clamp=False)
+    b = ipe.array(1,dists,False,clamp=False) - a
+    magmin,magmax = magrange[0],magrange[-1]
+    ntrials,nobs = dists.shape
+    totalwt2 = (counts * wts**2).sum(axis=1)
+    wts = counts * wts
+
+    # Squared residual as k0 + k1*mag + k2*mag**2. Below all breakpoints
+    # every observation is clamped to 1.0; each breakpoint then changes
+    # the contribution of one observation.
+    k0start = (wts * (cdis - 1)**2).sum(axis=1)
+    clamp2 = wts * (cdis - 2)**2
+    breaks = np.concatenate([(1 - a) / b,(2 - a) / b],axis=1)
+    dk0 = np.concatenate([clamp2 - wts * (cdis - 1)**2,
+                          wts * (cdis - a)**2 - clamp2],axis=1)
+    dk1 = np.concatenate([np.zeros(dists.shape),
+                          -2 * wts * b * (cdis - a)],axis=1)
+    dk2 = np.concatenate([np.zeros(dists.shape),wts * b**2],axis=1)
+
+    order = np.argsort(breaks,axis=1,kind='stable')
+    breaks = np.take_along_axis(breaks,order,axis=1)
+    zeros = np.zeros((ntrials,1))
+    k0 = np.hstack([zeros,np.cumsum(np.take_along_axis(dk0,order,axis=1),
+                                    axis=1)]) + k0start[:,np.newaxis]
+    k1 = np.hstack([zeros,np.cumsum(np.take_along_axis(dk1,order,axis=1),
+                                    axis=1)])
+    k2 = np.hstack([zeros,np.cumsum(np.take_along_axis(dk2,order,axis=1),
+                                    axis=1)])
+
+    # Segment i lies between breakpoints i-1 and i
+    lo = np.hstack([np.full((ntrials,1),-np.inf),breaks])
+    hi = np.hstack([breaks,np.full((ntrials,1),np.inf)])
+    lo = np.maximum(lo,magmin)
+    hi = np.minimum(hi,magmax)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mags = np.where(k2 > 0,-k1 / (2 * k2),lo)
+    mags = np.clip(mags,lo,hi)
+    totalresid2 = k0 + k1 * mags + k2 * mags**2
+    totalresid2[lo > hi] = np.inf
+
+    best = np.argmin(totalresid2,axis=1)[:,np.newaxis]
+    bestmags = np.take_along_axis(mags,best,axis=1)[:,0]
+    bestresid2 = np.take_along_axis(totalresid2,best,axis=1)[:,0]
+    bestresid2 = np.maximum(bestresid2,0) / totalwt2
+
+    resids = np.round(np.sqrt(bestresid2),PRECISION)
+    return np.round(bestmags,2),resids
+
+
+def trylocation_B(ipe,cdis,dists,wts,counts=1):
+    """
+    Vectorized version of locate_dyfi.trylocation_B
+    Returns (mag,resid) arrays, one value per trial epicenter
+    Trial epicenters without any usable observation get resid=inf
+    counts is the number of observations each column stands for
+    """
+
+    trymags = ipe.array(cdis,dists,True)
+    valid = trymags <= MAXMAG
+
+    totalwt = np.where(valid,counts,0).sum(axis=1)
+    totalmag = np.where(valid,counts * trymags,0).sum(axis=1)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        meanmags = totalmag / totalwt
+
+        totalresid2 = np.where(valid,
+            counts * (wts * (trymags - meanmags[:,np.newaxis]))**2,
+            0).sum(axis=1)
+        totalwt2 = np.where(valid,counts * wts**2,0).sum(axis=1)
+        resids = np.sqrt(totalresid2 / totalwt2)
+
+    resids = np.where(totalwt > 0,np.round(resids,PRECISION),np.inf)
+    meanmags = np.where(totalwt > 0,np.round(meanmags,1),0)
+    return meanmags,resids
+
+
+if __name__=='__main__':
+    import argparse
+    import json
+    import time
+    from modules.locate_dyfi import magrange
+    from modules.observations import Observations
+
+    parser=argparse.ArgumentParser(
+        description='Benchmark the type A magnitude scan against the solver.'
+    )
+    parser.add_argument('inputfile',type=str,nargs='?',
+        default='triggers/1553137916.geojson',
+        help='Autolocator trigger file (aggregated observations)')
+    parser.add_argument('--repeat',type=int,default=5,
+        help='Number of timing runs (default 5)')
+    args=parser.parse_args()
+
+    with open(args.inputfile,'r') as f:
+        obs=Observations(json.load(f)['features'])
+
+    obslons,obslats,cdis=obs.lon,obs.lat,obs.cdi
+    center=obs.feature(int(np.argmax(cdis)))
+
+    for ipe in (ipes.aww2014wna,ipes.aww2014ena):
+        for gridstep in (50,5):
+            ixs,iys=getGridOffsets(gridstep)
+            trylons,trylats=getOffsetPts(center,ixs,iys)
+            dists,wts=getDistancesWts(trylons,trylats,obslons,obslats)
+
+            results={}
+            for solver,f in (('scan',trylocation_A),
+                             ('solve',trylocation_A_solve)):
+                t0=time.time()
+                for i in range(args.repeat):
+                    mags,resids=f(ipe,cdis,dists,wts,magrange)
+                results[solver]=(mags,resids,(time.time()-t0)/args.repeat)
+
+            scanmags,scanresids,scantime=results['scan']
+            mags,resids,solvetime=results['solve']
+            best=int(np.argmin(scanresids))
+            print('%s, gridstep %i km:' % (ipe.name,gridstep))
+            print('  scan %.2f ms, solve %.2f ms' %
+                  (scantime*1000,solvetime*1000))
+            print('  best trial: scan M%.1f resid %.4f, solve M%.2f resid %.4f'
+                  % (scanmags[best],scanresids[best],mags[best],resids[best]))
+            print('  all trials: max resid change %+.4f' %
+                  (resids-scanresids).max())
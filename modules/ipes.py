@@ -7,6 +7,7 @@ Created on Wed Feb 10 17:51:20 2016
 """
 
 import math
+import numpy as np
 
 C = (0,0.309,1.864,-1.672,-0.00219,1.77,-0.383);
 
@@ -80,7 +81,80 @@ def aww2014ena(mag,r,inverse):
     if ii < 1.0: ii = 1.0
     return ii
     
+def aww2014wna_array(mag,r,inverse,clamp=True):
+    """
+    Array version of aww2014wna, mag and r are NumPy arrays
+    (or scalars) and are broadcast against each other
+    Returns intensity = f(mag,r) as an array
+
+    If inverse is true, returns mag = f(intensity,r)
+    If clamp is false, intensities below 2.0 are not clamped
+    """
+
+    R,B,logr = _distanceTerms(r)
+
+    if inverse:
+        ii = np.asarray(mag,dtype=float)
+        return (ii - C[1] - C[3]*logr - C[4]*R - C[5]*B) / (C[2] + C[6]*logr)
+
+    mag = np.asarray(mag,dtype=float)
+    ii = C[1] + C[2]*mag + C[3]*logr + C[4]*R + C[5]*B + C[6]*(mag*logr)
+    return clampIntensity(ii) if clamp else ii
+
+def aww2014ena_array(mag,r,inverse,clamp=True):
+    """
+    Array version of aww2014ena, mag and r are NumPy arrays
+    (or scalars) and are broadcast against each other
+    Returns intensity = f(mag,r) as an array
+
+    If inverse is true, returns mag = f(intensity,r)
+    If clamp is false, intensities below 2.0 are not clamped
+    """
+
+    r = np.asarray(r,dtype=float)
+    R,B,logr = _distanceTerms(r)
+
+    e1 = np.where(r < 1,1/50,np.minimum(r,150)/50)
+    ecorr = 0.7 + 0.001*r + np.maximum(0,0.8*np.log(e1))
+
+    if inverse:
+        ii = np.asarray(mag,dtype=float)
+        return ((ii - C[1] - ecorr - C[3]*logr - C[4]*R - C[5]*B) /
+                (C[2] + C[6]*logr))
+
+    mag = np.asarray(mag,dtype=float)
+    ii = C[1] + C[2]*mag + C[3]*logr + C[4]*R + C[5]*B + C[6]*(mag*logr)
+    ii = ii + ecorr
+    return clampIntensity(ii) if clamp else ii
+
+def _distanceTerms(r):
+    """
+    Returns the distance terms (R,B,logr) shared by the AWW2014 IPEs
+    Uses log(x)/log(10) like math.log(x,10) in the scalar versions
+    """
+
+    r = np.asarray(r,dtype=float)
+    R = np.sqrt(r**2 + 14**2)
+    B = np.where(R > 50,0,np.log(np.maximum(R,1)/50) / math.log(10))
+    logr = np.where(R > 1,np.log(np.maximum(R,1)) / math.log(10),0)
+    return R,B,logr
+
+def clampIntensity(ii):
+    """
+    Element-wise version of the intensity clamping in the scalar IPEs
+    """
+
+    ii = np.where((ii > 1.0) & (ii < 2.0),2.0,ii)
+    return np.where(ii < 1.0,1.0,ii)
+
 aww2014wna.name = 'Atkinson, Worden, Wald 2014 (WNA)'
 aww2014ena.name = 'Atkinson, Worden, Wald 2014 (ENA)'
+aww2014wna_array.name = aww2014wna.name
+aww2014ena_array.name = aww2014ena.name
+
+# Each scalar IPE knows its array version, so callers holding the
+# result of locate_dyfi.chooseIpe can switch to batched evaluation
+aww2014wna.array = aww2014wna_array
+aww2014ena.array = aww2014ena_array
 
  
\ No newline at end of file
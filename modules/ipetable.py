@@ -0,0 +1,185 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+ipetable.py : Tabulated IPEs for the magnitude scan of residual type A
+
+An IpeTable holds intensity = f(mag,dist) on a dense (magnitude x
+distance) grid and evaluates it by bilinear interpolation. Tables are
+built once per process (see getTable) and can be saved to disk.
+
+The table stores unclamped intensities; the clamping at 1.0/2.0 is
+applied after interpolation, so the clamps are exact. The AWW2014
+intensity is linear in magnitude, so interpolating between magnitude
+rows is exact too (this also holds outside the tabulated magnitudes).
+All the kinks of the AWW2014 distance terms (r=1, 48, 50, 150 km) fall
+on grid nodes.
+
+The only error left comes from interpolating in distance. With the
+default DISTSTEP of 0.05 km it is below 1e-5 intensity units for
+magnitudes up to 10 (table.maxerror has the value measured at build
+time). The exception is an intensity within that error of the 1.0
+clamp, which can land on the other side of the jump to 2.0. Distances
+beyond MAXDIST are computed exactly.
+
+"""
+
+import os
+import numpy as np
+
+from modules import ipes
+
+MAGS = [ x*0.1 for x in range(10,81) ]   # tabulated magnitudes
+DISTSTEP = 0.05     # km
+MAXDIST = 1000      # km, larger distances are not tabulated
+
+_tables = {}        # IpeTable objects built in this process, by IPE name
+
+
+class IpeTable():
+    """
+Tabulated version of an IPE (forward direction only).
+
+Usage:
+    table=IpeTable(ipes.aww2014ena)
+    ii=table.array(mag,dists,False) : same as ipe.array(mag,dists,False)
+
+    For many magnitudes at the same distances, look up the distances
+    once and reuse the result:
+        lookup=table.lookup(dists)
+        for mag in magrange:
+            ii=table.evaluate(mag,lookup)
+
+    table.maxerror : largest interpolation error found at build time
+    table.save(file), IpeTable.load(ipe,file) : store/restore the table
+
+    """
+
+    def __init__(self,ipe,mags=MAGS,diststep=DISTSTEP,maxdist=MAXDIST,
+                 values=None):
+
+        self.ipe = ipe
+        self.name = ipe.name
+        self.mags = np.asarray(mags,dtype=float)
+        self.magstep = self.mags[1] - self.mags[0]
+        self.diststep = diststep
+        self.maxdist = maxdist
+        self.dists = np.arange(0,round(maxdist/diststep)+1) * diststep
+
+        if values is None:
+            values = ipe.array(self.mags[:,np.newaxis],
+                               self.dists[np.newaxis,:],False,clamp=False)
+        self.values = values
+        self.maxerror = self.checkError()
+
+    def lookup(self,dists):
+        """
+        Find the distance interval and interpolation weight of each
+        distance. Returns an opaque value for evaluate()
+        """
+
+        dists = np.asarray(dists,dtype=float)
+        x = dists / self.diststep
+        i = np.minimum(np.floor(x).astype(int),len(self.dists) - 2)
+        t = x - i
+        outside = dists > self.maxdist
+        return (i,t,dists,outside if outside.any() else None)
+
+    def evaluate(self,mag,lookup):
+        """
+        Returns intensity = f(mag,dist) for the looked-up distances
+        """
+
+        i,t,dists,outside = lookup
+
+        # Interpolate (or extrapolate) between the two nearest rows
+        j = int((mag - self.mags[0]) // self.magstep)
+        j = min(max(j,0),len(self.mags) - 2)
+        u = (mag - self.mags[j]) / self.magstep
+        row = self.values[j] + u*(self.values[j+1] - self.values[j])
+
+        ii = row[i] + t*(row[i+1] - row[i])
+        if outside is not None:
+            ii[outside] = self.ipe.array(mag,dists[outside],False,
+                                         clamp=False)
+        return ipes.clampIntensity(ii)
+
+    def array(self,mag,r,inverse):
+        """
+        Same interface as the array IPEs in modules.ipes
+        The inverse direction is not tabulated and is computed exactly
+        """
+
+        if inverse:
+            return self.ipe.array(mag,r,True)
+        return self.evaluate(mag,self.lookup(r))
+
+    def checkError(self):
+        """
+        Returns the largest difference between interpolated and exact
+        intensities, at the midpoints of the distance intervals
+        """
+
+        mids = self.dists[:-1] + self.diststep/2
+        lookup = self.lookup(mids)
+        maxerror = 0
+        for mag in (self.mags[0],self.mags[-1]):
+            exact = self.ipe.array(mag,mids,False)
+            error = np.abs(self.evaluate(mag,lookup) - exact).max()
+            maxerror = max(maxerror,float(error))
+        return maxerror
+
+    def save(self,file):
+        np.savez(file,name=self.name,mags=self.mags,diststep=self.diststep,
+                 maxdist=self.maxdist,values=self.values)
+
+    @classmethod
+    def load(cls,ipe,file):
+        """
+        Returns the IpeTable stored in file, or None if it was
+        built for another IPE or with other grid parameters
+        """
+
+        with np.load(file) as data:
+            if (str(data['name']) != ipe.name
+                    or not np.array_equal(data['mags'],MAGS)
+                    or float(data['diststep']) != DISTSTEP
+                    or float(data['maxdist']) != MAXDIST):
+                return None
+            return cls(ipe,values=data['values'])
+
+
+def getTable(ipe,cachedir=None):
+    """
+    Returns the IpeTable for this IPE, building it on first use
+    If cachedir is set, the table is read from/written to that directory
+
+    Arguments:
+    ipe         IPE function with an array version (see modules.ipes)
+    cachedir    directory for persistent tables (optional)
+    """
+
+    if ipe.name in _tables:
+        return _tables[ipe.name]
+
+    table = None
+    if cachedir:
+        file = os.path.join(cachedir,tableFilename(ipe))
+        if os.path.exists(file):
+            table = IpeTable.load(ipe,file)
+
+    if not table:
+        table = IpeTable(ipe)
+        print('Built IPE table for %s (max error %.1e)' %
+              (ipe.name,table.maxerror))
+        if cachedir:
+            os.makedirs(cachedir,exist_ok=True)
+            table.save(file)
+
+    _tables[ipe.name] = table
+    return table
+
+
+def tableFilename(ipe):
+    name = ''.join([ c if c.isalnum() else '_' for c in ipe.name ])
+    return 'ipetable_%s.npz' % name.strip('_')
@@ -7,7 +7,8 @@ Created on Wed Feb 10 17:51:20 2016
 @author: vinceq
 
 Given a list of geojson points, iterate over them and determine
-the best location
+the best location. The points are converted once to an Observations
+object (see modules.observations) and are not modified.
 
 Ver. A: Compute residuals of intensity (previous Locator algorithm)
 Ver. B: Compute residuals of magnitude (conforms to B&W algorithm)
@@ -16,19 +17,55 @@ Ver. B: Compute residuals of magnitude (conforms to B&W algorithm)
 
 import math
 import json
+import time
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from geojson import Point,Feature
 from geopy.distance import great_circle
 
 from modules import ipes
+from modules import gridsearch
+from modules import ipetable
+from modules import spatial
+from modules.observations import Observations
+from modules.surface import ResidualSurface
 
-VER='0.2'
+VER='0.3'
 # Resid type A = residuals of intensities at each observation
 # Resid type B = residuals of magnitudes at each observation
 RESID_TYPE = 'B'
 
 STARTING_PT_TYPE = 'simple'
 
-FILTERBYLOC = ''
+# 'numpy' = batched grid search (modules.gridsearch)
+# 'python' = evaluate one trial epicenter at a time (loopGrid)
+LOCATE_BACKEND = 'numpy'
+
+# Observation filter applied before the search (see filterObs):
+# '' = no filter, 'isolated' = drop isolated outlier cells, or a
+# function(Feature) returning True for the observations to keep
+FILTERBYLOC = 'isolated'
+
+# Isolated cells: a cell with fewer than FILTER_MINNRESP responses is
+# dropped if the other cells within FILTER_RADIUS km have fewer than
+# FILTER_MINSCORE responses in total (see getIsolationScores)
+FILTER_RADIUS = 50
+FILTER_MINNRESP = 2
+FILTER_MINSCORE = 3
+
+# Observation cap for very large events (numpy backend only): with more
+# than OBS_CAP cells (0 = no cap), keep the near-field cells with high
+# cdi or nresp and draw a sample of the others, see capObs.
+# OBS_CAP_VALIDATE also runs the uncapped search and reports the
+# difference in location and magnitude.
+OBS_CAP = 0
+OBS_CAP_NEARDIST = 100      # km from the starting point
+OBS_CAP_KEEPCDI = 4.0
+OBS_CAP_KEEPNRESP = 5
+OBS_CAP_SEED = 0
+OBS_CAP_VALIDATE = False
 
 # TODO: Make these parameters configurable
 
@@ -36,19 +73,61 @@ PRECISION = 4
 magrange = [ x*0.1 for x in range(18,71) ]   # search parameters for magnitude
 
 IPEDISTS = [ x*0.1 for x in range(1,100)] + list(range(10,100)) + list(range(100,310,10))
-GRIDSTEP_INIT = 50
-GRIDSTEP_FINAL = 5
+
+# Hierarchical grid search: one (gridstep in km, gridsize) per level.
+# Each level searches (2*gridsize+1)**2 trial epicenters centered on
+# the best location of the previous level. Refinement stops early when
+# the residual improves by less than SEARCH_TOL. When the best location
+# is on the edge of a grid, that level is re-centered on it and searched
+# again (at most SEARCH_MAXSHIFTS times).
+# The previous fixed two-pass search is [ (50,10), (5,10) ].
+SEARCH_LEVELS = [ (50,4), (10,3), (2,3) ]
+SEARCH_TOL = 0.0001
+SEARCH_MAXSHIFTS = 5
+
+# Interpolate the type A magnitude scan from a precomputed IPE table
+# (see modules.ipetable). IPE_TABLE_DIR keeps the tables on disk.
+IPE_TABLE = False
+IPE_TABLE_DIR = None
+
+# Best magnitude for resid type A: 'scan' tries every value in magrange,
+# 'solve' computes the least-squares magnitude (numpy backend only)
+MAG_SOLVER = 'scan'
+
+# Worker processes for the trial epicenters of each grid (numpy backend)
+WORKERS = 1
+
+# Group far-field observations (weight 0.1 at every trial epicenter of
+# a grid) into cubes of this size in km, 0 = evaluate all exactly
+# (numpy backend, see gridsearch.GridSearch). Only pays off for cubes
+# well above the aggregation cell size, e.g. 50. The mag and resid of
+# the best location are then recomputed from all observations.
+FARFIELD_GROUPING = 0
+
+# Module settings used by locate(), copied to the locate_many() workers
+SETTINGS = [ 'RESID_TYPE','STARTING_PT_TYPE','LOCATE_BACKEND','FILTERBYLOC',
+             'magrange','SEARCH_LEVELS','SEARCH_TOL','SEARCH_MAXSHIFTS',
+             'IPE_TABLE','IPE_TABLE_DIR','MAG_SOLVER','FARFIELD_GROUPING',
+             'FILTER_RADIUS','FILTER_MINNRESP','FILTER_MINSCORE',
+             'OBS_CAP','OBS_CAP_NEARDIST','OBS_CAP_KEEPCDI',
+             'OBS_CAP_KEEPNRESP','OBS_CAP_SEED','OBS_CAP_VALIDATE' ]
 #TRYLOCATIONF = 0
 
-def locate(obs):
+def locate(obs,surface=None):
     """
     Iterate over observations to determine best location
     Returns GeoJSON Feature: epicenter with mag, resid
     
     Arguments:    
-    obs: geojson feature collection (list of GeoJSON points)
+    obs: geojson feature collection (list of GeoJSON points),
+         or Observations
+    surface: ResidualSurface (optional), gets the results of every
+         trial epicenter (see modules.surface)
     """
 
+    if not isinstance(obs,Observations):
+        obs = Observations(obs)
+
     if STARTING_PT_TYPE == 'mean':
         getStartingPt = getStartingPt_mean
     else:
@@ -57,7 +136,8 @@ def locate(obs):
     initloc = getStartingPt(obs)
     ipe = chooseIpe(initloc)
     bestloc = initloc
-    saveresults = []
+    if surface is None:
+        surface = ResidualSurface()
 
     # Also run a sanity check on locations
 
@@ -65,42 +145,273 @@ def locate(obs):
     print('After filtering, left with ' + str(len(obs)) + ' locs.')
     initloc = getStartingPt(obs)
 
+    fullobs = obs
+    if OBS_CAP and len(obs) > OBS_CAP:
+        obs = capObs(obs,initloc,OBS_CAP)
+
+    bestloc = searchObs(ipe,obs,initloc,surface)
+
+    if OBS_CAP_VALIDATE and obs is not fullobs:
+        bestloc['properties']['capcheck'] = validateCap(ipe,fullobs,
+                                                        initloc,bestloc)
+
+     # Now we have min(residuals) == rms0[MI-Mi]
+    # Calculate rmsMI = rms[MI] = rms[MI-Mi] - rms0 for each trial epicenter
+
+    bestresid = bestloc['properties']['resid']
+    surface.setBest(bestresid)
+    bestloc['properties']['rmsMI'] = 0.0
+
+    return bestloc
+
+def searchObs(ipe,obs,initloc,surface):
+    """
+    Run the hierarchical grid search (see SEARCH_LEVELS)
+    Returns GeoJSON Feature: best trial epicenter with mag, resid
+    """
+
     global TRYLOCATIONF
     if RESID_TYPE == 'A':
         TRYLOCATIONF = trylocation_A
     else:
         TRYLOCATIONF = trylocation_B
 
-    initloc = loopGrid(ipe,initloc,obs,GRIDSTEP_INIT,saveresults)
-    bestloc = loopGrid(ipe,initloc,obs,GRIDSTEP_FINAL,saveresults)
+    engine = None
+    if LOCATE_BACKEND == 'numpy':
+        engine = getEngine(ipe,obs)
+        searchGrid = engine.loopGrid
+    else:
+        def searchGrid(initloc,gridstep,gridsize,surface):
+            return loopGrid(ipe,initloc,obs,gridstep,gridsize,surface)
+
+    try:
+        bestloc = initloc
+        bestresid = None
+        for level,(gridstep,gridsize) in enumerate(SEARCH_LEVELS):
+            surface.level = level
+            bestloc = searchLevel(searchGrid,bestloc,gridstep,gridsize,
+                                  surface)
+            resid = bestloc['properties']['resid']
+            if bestresid is not None and bestresid - resid < SEARCH_TOL:
+                print('Level %i improved resid by less than %s, stopping.' %
+                      (level,SEARCH_TOL))
+                break
+            bestresid = resid
+
+        if engine and engine.farfieldstats['nfar']:
+            stats = engine.farfieldstats
+            error = engine.farFieldError(bestloc)
+            print('Far field: up to %i obs in %i groups, distance error <= %s km,'
+                  ' at best loc dmag=%s dresid=%s' % (stats['nfar'],
+                  stats['ngroups'],stats['maxdisterror'],
+                  error['dmag'],error['dresid']))
+
+            # Report the exact values, not the grouped ones
+            bestloc['properties']['mag'] = error['mag']
+            bestloc['properties']['resid'] = error['resid']
+    finally:
+        if engine:
+            engine.close()
+
+    print('Evaluated %i trial epicenters.' % len(surface))
+    return bestloc
 
-     # Now we have min(residuals) == rms0[MI-Mi]
-    # Calculate rmsMI = rms[MI] = rms[MI-Mi] - rms0 for each trial epicenter
+def capObs(obs,initloc,cap):
+    """
+    Reduce obs to at most cap observations
+    Returns Observations
+
+    Cells within OBS_CAP_NEARDIST of initloc with cdi at least
+    OBS_CAP_KEEPCDI or nresp at least OBS_CAP_KEEPNRESP are all kept
+    (at most half of cap, the ones with the highest cdi and nresp).
+    The others are sampled with probability proportional to
+    nresp times their distance weight from initloc (systematic
+    sampling, exact sample size and inclusion probabilities). Each
+    sampled cell gets weight 1/probability, so the weighted residual
+    sums are unbiased estimates of the full ones.
+    """
 
-    bestresid = bestloc['properties']['resid']
-    for trialloc in saveresults:
-        p = trialloc['properties']
-        p['rmsMI'] = p['resid'] - bestresid
+    if LOCATE_BACKEND != 'numpy':
+        print('WARNING: OBS_CAP needs the numpy backend, not capping.')
+        return obs
+
+    lon0,lat0 = initloc['geometry']['coordinates']
+    dists,wts = gridsearch.getDistancesWts([lon0],[lat0],obs.lon,obs.lat)
+    dists,wts = dists[0],wts[0]
+    keep = (dists <= OBS_CAP_NEARDIST) & ((obs.cdi >= OBS_CAP_KEEPCDI) |
+                                          (obs.nresp >= OBS_CAP_KEEPNRESP))
+    kept = np.nonzero(keep)[0]
+
+    # Leave at least half of the cap for the sample
+    if len(kept) > cap // 2:
+        order = np.lexsort((dists[kept],-obs.nresp[kept],-obs.cdi[kept]))
+        kept = np.sort(kept[order[:cap // 2]])
+        keep[:] = False
+        keep[kept] = True
+
+    rest = np.nonzero(~keep)[0]
+    probs = getInclusionProbs(obs.nresp[rest] * wts[rest],cap - len(kept))
+    rng = np.random.default_rng(OBS_CAP_SEED)
+    chosen = rest[systematicSample(probs,rng)]
+
+    weights = np.ones(len(obs))
+    weights[rest] = 1 / probs
+    index = np.sort(np.concatenate([kept,chosen]))
+    capped = obs.subset(index)
+    capped.weight = weights[index]
+
+    print('Capping %i obs: kept %i near-field, sampled %i of %i others.' %
+          (len(obs),len(kept),len(chosen),len(rest)))
+    return capped
+
+def getInclusionProbs(sizes,n):
+    """
+    Inclusion probabilities proportional to sizes for a sample of n
+    Probabilities above 1 are set to 1 and the rest scaled up again
+    """
 
-    # Recalculate distances in each observation (this will get saved later)
-    # And get a line of points for plotting
+    sizes = np.asarray(sizes,dtype=float)
+    certain = np.zeros(len(sizes),dtype=bool)
+    while True:
+        rest = ~certain
+        probs = np.ones(len(sizes))
+        probs[rest] = ((n - certain.sum()) * sizes[rest] /
+                       sizes[rest].sum())
+        over = rest & (probs >= 1)
+        if not over.any():
+            return probs
+        certain |= over
+
+def systematicSample(probs,rng):
+    """
+    Systematic sampling in random order: returns the indices (sorted)
+    of a sample of round(sum(probs)) units, unit i being included with
+    probability probs[i]
+    """
 
-    getDistancesWts(bestloc['geometry'],obs)
-    bestmag = bestloc['properties']['mag']
-    #ipeline = getipeline(ipe,bestmag,IPEDISTS)
+    order = rng.permutation(len(probs))
+    cum = np.cumsum(probs[order])
+    start = rng.random()
+    upper = np.floor(cum - start)
+    lower = np.floor(np.concatenate([[0],cum[:-1]]) - start)
+    return np.sort(order[upper > lower])
 
+def validateCap(ipe,fullobs,initloc,bestloc):
+    """
+    Run the search on all observations and compare with bestloc
+    Returns dict: ddist (km), dmag, dresid (capped minus uncapped)
+    """
+
+    fullloc = searchObs(ipe,fullobs,initloc,ResidualSurface())
+    lon1,lat1 = bestloc['geometry']['coordinates']
+    lon2,lat2 = fullloc['geometry']['coordinates']
+    check = {
+        'ddist' : round(great_circle((lat1,lon1),(lat2,lon2)).km,PRECISION),
+        'dmag' : round(bestloc['properties']['mag'] -
+                       fullloc['properties']['mag'],2),
+        'dresid' : round(bestloc['properties']['resid'] -
+                         fullloc['properties']['resid'],PRECISION)
+    }
+    print('Cap check against %i obs: ddist=%s km dmag=%s dresid=%s' %
+          (len(fullobs),check['ddist'],check['dmag'],check['dresid']))
+    return check
+
+def locate_many(obssets,workers=None):
+    """
+    Locate several sets of observations in one call, e.g. to reprocess
+    many events or time windows
+    Returns (locs,times): the result of locate() for each set, and the
+    time in seconds spent on each set
+
+    Each set is located exactly as locate() would. Tables that do not
+    depend on the observations (IPE tables, grid offsets) are built
+    once and shared. With workers>1 the sets are located in a process
+    pool; the grid of each set is then evaluated in a single process
+    (WORKERS is not used).
+
+    Arguments:
+    obssets     list of observation sets (see locate)
+    workers     number of worker processes, default WORKERS
+    """
+
+    if workers is None:
+        workers = WORKERS
+
+    # Build the tables once, before the workers start
+    if IPE_TABLE and RESID_TYPE == 'A' and LOCATE_BACKEND == 'numpy':
+        for ipe in (ipes.aww2014wna,ipes.aww2014ena):
+            ipetable.getTable(ipe,IPE_TABLE_DIR)
+    for gridstep,gridsize in SEARCH_LEVELS:
+        gridsearch.getGridOffsets(gridstep,gridsize)
+
+    if workers > 1 and len(obssets) > 1:
+        # Forked workers already have the tables; settings are small
+        # and sent with each set (no pool initializer before Python 3.7)
+        settings = { key:globals()[key] for key in SETTINGS }
+        settings['WORKERS'] = 1
+        tables = None
+        if multiprocessing.get_start_method() != 'fork':
+            tables = ipetable._tables
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(functools.partial(
+                _locateTimed,settings=settings,tables=tables),obssets))
+    else:
+        results = [ _locateTimed(obs) for obs in obssets ]
+
+    locs = [ r[0] for r in results ]
+    times = [ r[1] for r in results ]
+    return locs,times
+
+def _locateTimed(obs,settings=None,tables=None):
+    if settings:
+        globals().update(settings)
+    if tables:
+        ipetable._tables.update(tables)
+    start = time.perf_counter()
+    loc = locate(obs)
+    return loc,round(time.perf_counter() - start,4)
+
+def searchLevel(searchGrid,initloc,gridstep,gridsize,surface):
+    """
+    Search one level of the hierarchical grid (see SEARCH_LEVELS)
+    If the best trial epicenter lands on the edge of the grid, the grid
+    is shifted to center on it and searched again
+    Returns GeoJSON Feature: best trial epicenter
+
+    Arguments:
+    searchGrid  function(initloc,gridstep,gridsize,surface)
+                evaluating one grid, see locate()
+    initloc     grid center, GeoJSON Feature
+    gridstep    grid spacing in km
+    gridsize    number of grid steps on each side of initloc
+    surface     ResidualSurface, gets the results of every grid
+    """
+
+    bestloc = searchGrid(initloc,gridstep,gridsize,surface)
+    edge = gridstep * gridsize
+    for shift in range(SEARCH_MAXSHIFTS):
+        p = bestloc['properties']
+        if 'ix' not in p or (abs(p['ix']) < edge and abs(p['iy']) < edge):
+            break
+
+        print('Best loc on grid edge (%i,%i), shifting grid.' %
+              (p['ix'],p['iy']))
+        newloc = searchGrid(bestloc,gridstep,gridsize,surface)
+        if newloc['properties']['resid'] >= p['resid']:
+            break
+        bestloc = newloc
 
-    allgeojson = { 'type' : 'FeatureCollection', 'features' : saveresults }
     return bestloc
 
-def loopGrid(ipe,initloc,obs,gridstep,saveresults):
+def loopGrid(ipe,initloc,obs,gridstep,gridsize,surface):
 
     counter = 0
     bestloc = initloc
     bestresid = 9999
+    lons,lats,mags,resids = [],[],[],[]
 
-    xgridrange = [ x * gridstep for x in range(-10,11) ]
-    ygridrange = [ x * gridstep for x in range(-10,11) ]
+    xgridrange = [ x * gridstep for x in range(-gridsize,gridsize+1) ]
+    ygridrange = [ x * gridstep for x in range(-gridsize,gridsize+1) ]
     for ix in xgridrange:
         for iy in ygridrange:
             counter += 1
@@ -110,6 +421,8 @@ def loopGrid(ipe,initloc,obs,gridstep,saveresults):
                     (counter,p['ix'],p['iy']))
 
             tryloc = getOffsetPt(initloc,ix,iy)
+            lons.append(tryloc['coordinates'][0])
+            lats.append(tryloc['coordinates'][1])
 
             # Calculate distances and weights only once per trial epicenter
             getDistancesWts(tryloc,obs)
@@ -118,23 +431,40 @@ def loopGrid(ipe,initloc,obs,gridstep,saveresults):
             # epicenter by iterating through each observation
             result = TRYLOCATIONF(ipe,obs)
             if not result:
+                mags.append(math.nan)
+                resids.append(math.nan)
                 continue
 
             resid = result['resid']
+            mags.append(result['mag'])
+            resids.append(resid)
             props = {
                 'mag' : result['mag'],
                 'resid' : resid, 
                 'ix': ix, 'iy' : iy 
             }
-            loc = Feature(geometry=tryloc,properties=props)
-            saveresults.append(loc)
 
             # Keep track of the best trial epicenter
             if (resid < bestresid):
                 bestresid = resid
-                bestloc = loc
+                bestloc = Feature(geometry=tryloc,properties=props)
 
+    surface.addGrid(initloc['geometry']['coordinates'],gridstep,gridsize,
+                    lons,lats,mags,resids)
     return bestloc
+
+def getEngine(ipe,obs):
+    """
+    Returns the gridsearch.GridSearch engine (numpy backend) for
+    these observations, set up from the module settings
+    """
+
+    table = None
+    if IPE_TABLE and RESID_TYPE == 'A':
+        table = ipetable.getTable(ipe,IPE_TABLE_DIR)
+
+    return gridsearch.GridSearch(ipe,obs,RESID_TYPE,magrange,table,
+                                 MAG_SOLVER,WORKERS,FARFIELD_GROUPING)
                 
 def getStartingPt_simple(pts):
     """
@@ -142,16 +472,15 @@ def getStartingPt_simple(pts):
     Returns GeoJSON point
 
     Arguments:
-    pts: geojson feature collection (list of GeoJSON points)
+    pts: Observations
     """
     
     maxcdi = 0.0
     bestpt = 0
-    for pt in pts:
-        cdi = pt['properties']['cdi']
+    for i,cdi in enumerate(pts.cdi):
         if cdi > maxcdi:
             maxcdi = cdi
-            bestpt = pt
+            bestpt = pts.feature(i)
             
     return bestpt
 
@@ -183,8 +512,7 @@ def trylocation_A(ipe,pts):
     returns [ 'mag' : best magnitude, 'resid' : lowest residual ]
         
     Arguments:
-    pts    GeoJSON feature collection (list of GeoJSON points)
-    loc    GeoJSON point (dict)
+    pts    Observations, with dist and wt set for the trial epicenter
     """
     
     bestresid2 = 9999       # Best squared resid so far
@@ -194,13 +522,12 @@ def trylocation_A(ipe,pts):
         # Now iterate through each point and add up the resids
         totalresid2 = 0     # Cumulative total of squared resids
         totalwt2 = 0        # Cumulative total of squared weights
-        for pt in pts:
-            # Todo: Implement this as Point object property            
-            ii = pt['properties']['cdi']
-            dist = pt['properties']['_dist']
+        for i in range(len(pts)):
+            ii = float(pts.cdi[i])
+            dist = float(pts.dist[i])
             tryii = ipe(trymag,dist,False)
             
-            wt = pt['properties']['_wt']
+            wt = float(pts.wt[i])
             totalresid2 += wt*(ii - tryii)**2
             totalwt2 += wt**2
 
@@ -221,8 +548,7 @@ def trylocation_B(ipe,obs):
     returns [ 'mag' : best magnitude, 'resid' : lowest residual ]
         
     Arguments:
-    trialloc    GeoJSON point (dict)
-    obs         GeoJSON feature collection (list of GeoJSON points)
+    obs         Observations, with dist and wt set for the trial epicenter
     """
     
 
@@ -231,17 +557,18 @@ def trylocation_B(ipe,obs):
 
     totalmag = 0
     totalwt = 0
-    for ob in obs:
-        # Todo: Implement this as Point object property            
-        ii = ob['properties']['cdi']
-        dist = ob['properties']['_dist']
+    for i in range(len(obs)):
+        ii = float(obs.cdi[i])
+        dist = float(obs.dist[i])
 
         trymag = ipe(ii,dist,True)
 
         if trymag>8.1:
+            # Drop the value left over from a previous trial epicenter
+            obs.mag[i] = math.nan
             continue
 
-        ob['properties']['_mag'] = trymag        
+        obs.mag[i] = trymag
         #nresp = ob['properties']['nresp']
         totalmag += trymag
         totalwt +=  1
@@ -263,12 +590,12 @@ def trylocation_B(ipe,obs):
 
     totalresid2 = 0
     totalwt2 = 0
-    for ob in obs:
-        if '_wt' not in ob['properties'] or '_mag' not in ob['properties']:
+    for i in range(len(obs)):
+        if math.isnan(obs.wt[i]) or math.isnan(obs.mag[i]):
             continue
 
-        wt = ob['properties']['_wt']
-        thismag = ob['properties']['_mag']
+        wt = float(obs.wt[i])
+        thismag = float(obs.mag[i])
         totalresid2 += (wt * (thismag - meanmag))**2
         totalwt2 += wt**2
 
@@ -288,16 +615,16 @@ def getDistancesWts(trialloc,pts):
     
     Arguments:
     trialloc    geojson point (dict)
-    pts         geojson feature collection (list of GeoJSON points)
+    pts         Observations, dist and wt are set for trialloc
     """
     
     counter = 0    
     lat0 = trialloc['coordinates'][1]
     lon0 = trialloc['coordinates'][0]
     
-    for pt in pts:
-        lat1 = pt['geometry']['coordinates'][1]
-        lon1 = pt['geometry']['coordinates'][0]
+    for i in range(len(pts)):
+        lat1 = float(pts.lat[i])
+        lon1 = float(pts.lon[i])
         dist = great_circle((lat0,lon0),(lat1,lon1)).kilometers
         
         if dist >= 150:
@@ -311,8 +638,8 @@ def getDistancesWts(trialloc,pts):
 
         dist = round(dist,PRECISION)
         wt = round(wt,PRECISION)
-        pt['properties']['_dist'] = dist
-        pt['properties']['_wt'] = wt        
+        pts.dist[i] = dist
+        pts.wt[i] = wt
         counter += 1
 
     return(counter)
@@ -328,22 +655,21 @@ def getStartingPt_mean(pts):
     Returns GeoJSON point
 
     Arguments:
-    pts: geojson feature collection (list of GeoJSON points)
+    pts: Observations
     """
     
     maxcdi = 0.0
     startpt = 0
-    for pt in pts:
-        cdi = pt['properties']['cdi']
+    for i,cdi in enumerate(pts.cdi):
         if cdi > maxcdi:
             maxcdi = cdi
-            bestpt = pt
+            startpt = i
 
-    startpt = bestpt
+    bestpt = pts.feature(startpt)
 
-    for pt in pts:
-        if pt == startpt: continue
-        bestpt = addpts(bestpt,pt,cdiwt(cdi))
+    for i in range(len(pts)):
+        if i == startpt: continue
+        bestpt = addpts(bestpt,pts.feature(i),cdiwt(cdi))
             
     return bestpt
 
@@ -370,9 +696,9 @@ def getipeline(ipe,mag,dists):
         'name' : ipe.name,
         'mag' : mag
     }
+    iis = ipe.array(mag,dists,False)
     values = []
-    for dist in dists:
-        ii = ipe(mag,dist,False)
+    for dist,ii in zip(dists,iis.tolist()):
         if ii < 2: continue
         ii = round(ii,2)
         values.append({ 'x':dist, 'y':ii})
@@ -392,14 +718,45 @@ def chooseIpe(loc):
     return ipe
 
 def filterObs(obs):
-    newobs = []
+    keep = []
     if not FILTERBYLOC:
       return obs
-    for ob in obs:        
-        if FILTERBYLOC(ob):
-            newobs.append(ob)
+    if FILTERBYLOC == 'isolated':
+      return filterIsolated(obs)
+    for i in range(len(obs)):
+        if FILTERBYLOC(obs.feature(i)):
+            keep.append(i)
         else:
             pass
 
-    return newobs
+    return obs.subset(keep)
+
+def filterIsolated(obs):
+    """
+    Remove isolated outlier cells (mostly spurious single reports far
+    from the cluster), see FILTER_RADIUS, FILTER_MINNRESP, FILTER_MINSCORE
+    Returns Observations
+    """
+
+    if not len(obs):
+        return obs
+
+    scores = getIsolationScores(obs,FILTER_RADIUS)
+    outliers = (obs.nresp < FILTER_MINNRESP) & (scores < FILTER_MINSCORE)
+    if outliers.all():
+        print('All cells are isolated, not filtering.')
+        return obs
+
+    print('Filtered out %i isolated cells (of %i).' %
+          (outliers.sum(),len(obs)))
+    return obs.subset(~outliers)
+
+def getIsolationScores(obs,radius):
+    """
+    Returns the isolation score of each observation: the number of
+    responses in the other cells within radius km (0 = isolated)
+    """
+
+    index = spatial.SpatialIndex(obs.lon,obs.lat,radius)
+    return index.neighbours(radius,obs.nresp)
     
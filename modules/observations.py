@@ -0,0 +1,90 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+observations.py : Array-backed store of aggregated observations
+
+The locator works on an Observations object instead of the GeoJSON
+Features returned by aggregate(). Per-observation values are kept in
+NumPy arrays (struct of arrays), including the scratch columns the
+locator fills for a trial epicenter. The input Features are never
+modified.
+
+"""
+
+import numpy as np
+from geojson import Point,Feature
+
+
+class Observations():
+    """
+Aggregated observations as NumPy arrays.
+
+Usage:
+    obs=Observations(aggregated) : aggregated is the output of aggregate()
+
+    obs.lon, obs.lat : coordinates of each observation
+    obs.cdi, obs.nresp : intensity and number of responses
+    obs.weight : number of observations each one stands for in the
+        residuals (1, except in a sample, see locate_dyfi.capObs)
+    obs.dist, obs.wt, obs.mag : scratch columns for the locator
+        (distance and weight to a trial epicenter, magnitude derived
+        from the observation), NaN until set
+    len(obs) : number of observations
+
+    obs.subset(index) : Observations for a boolean mask or index array
+    obs.feature(i) : GeoJSON Point Feature for observation i
+    obs.toFeatures() : the input Features for these observations
+
+    """
+
+    def __init__(self,features):
+
+        self.features = list(features)
+        self.index = np.arange(len(self.features))
+
+        coords = [ f['geometry']['coordinates'] for f in self.features ]
+        self.lon = np.array([ c[0] for c in coords ],dtype=float)
+        self.lat = np.array([ c[1] for c in coords ],dtype=float)
+        self.cdi = np.array([ f['properties']['cdi']
+                              for f in self.features ],dtype=float)
+        self.nresp = np.array([ f['properties'].get('nresp',1)
+                                for f in self.features ],dtype=int)
+        self.weight = np.ones(len(self.features))
+        self.clearScratch()
+
+    def clearScratch(self):
+        n = len(self.index)
+        self.dist = np.full(n,np.nan)
+        self.wt = np.full(n,np.nan)
+        self.mag = np.full(n,np.nan)
+
+    def __len__(self):
+        return len(self.index)
+
+    def subset(self,index):
+        """
+        Returns a new Observations with the selected observations
+        The scratch columns are not copied
+        """
+
+        new = Observations.__new__(Observations)
+        new.features = self.features
+        new.index = self.index[index]
+        for column in ('lon','lat','cdi','nresp','weight'):
+            setattr(new,column,getattr(self,column)[index])
+        new.clearScratch()
+        return new
+
+    def feature(self,i):
+        """
+        Returns a GeoJSON Point Feature for observation i
+        """
+
+        return Feature(
+            geometry=Point((float(self.lon[i]),float(self.lat[i]))),
+            properties={ 'cdi':float(self.cdi[i]),'nresp':int(self.nresp[i]) }
+        )
+
+    def toFeatures(self):
+        return [ self.features[i] for i in self.index ]
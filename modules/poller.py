@@ -0,0 +1,103 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+poller.py : Incremental polling of new responses
+
+Keeps the responses of a moving time window in memory and only asks
+the database for rows newer than the last one seen (high-water mark on
+subid), so each poll costs as much as the responses that came in since
+the previous one instead of the whole window.
+
+"""
+
+import datetime
+from collections import deque
+import geojson
+
+MAXSIZE = 100000    # responses kept, the oldest are dropped past this
+
+
+class ResponsePoller():
+    """
+Ring buffer of the responses of the last window minutes.
+
+Usage:
+    poller=ResponsePoller(db,window,[table],[unknown],[maxsize])
+    n=poller.poll([now]) : fetch the rows newer than the high-water
+        mark, drop the ones older than now-window, returns the number
+        of new rows
+    fc=poller.features() : FeatureCollection of the window, same as
+        db.extquery of the window (for aggregate.aggregatePyramid)
+    len(poller) : number of responses in the window
+
+    poller.lastsubid, poller.lasttime : high-water mark (largest subid
+        and time_now ingested)
+
+    With unknown=True only rows with eventid="unknown" are fetched.
+    Rows associated with an event after they were fetched stay in the
+    buffer until they expire.
+
+    """
+
+    def __init__(self,db,window,table='latest',unknown=True,maxsize=MAXSIZE):
+        self.db = db
+        self.window = datetime.timedelta(minutes=window)
+        self.table = table
+        self.unknown = unknown
+        self.buffer = deque(maxlen=maxsize)
+        self.lastsubid = None
+        self.lasttime = None
+        self.t0 = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def poll(self,now=None):
+        """
+        Fetch the new rows and expire the old ones, returns the number
+        of new rows
+        """
+
+        if now is None:
+            now = datetime.datetime.now().replace(microsecond=0)
+        self.t0 = now - self.window
+
+        querytext = 'time_now>"{}"'.format(self.t0)
+        if self.lastsubid is not None:
+            querytext += ' AND subid>{}'.format(self.lastsubid)
+        if self.unknown:
+            querytext += ' AND eventid="unknown"'
+        querytext += ' ORDER BY subid'
+
+        mark = self.lastsubid
+        nnew = 0
+        for feature in self.db.iterext('cdi',self.table,querytext):
+            props = feature['properties']
+            if mark is not None and props['subid'] <= mark:
+                continue
+            if self.lastsubid is None or props['subid'] > self.lastsubid:
+                self.lastsubid = props['subid']
+            if self.lasttime is None or props['time_now'] > self.lasttime:
+                self.lasttime = props['time_now']
+            self.buffer.append(feature)
+            nnew += 1
+
+        # Rows come in subid order, which is close to time order
+        while self.buffer and \
+                self.buffer[0]['properties']['time_now'] <= self.t0:
+            self.buffer.popleft()
+
+        print('Polled %i new responses, %i in the window.' %
+              (nnew,len(self)))
+        return nnew
+
+    def features(self):
+        """
+        Returns a FeatureCollection of the responses in the window
+        """
+
+        return geojson.FeatureCollection([
+            feature for feature in self.buffer
+            if self.t0 is None or feature['properties']['time_now'] > self.t0
+        ])
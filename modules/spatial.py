@@ -0,0 +1,155 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+spatial.py : Spatial index over observation points
+
+Points are placed on the unit sphere (3D unit vectors) and bucketed
+into cubes of a fixed size. Great-circle distance is a monotonic
+function of the straight-line (chord) distance between unit vectors,
+so a radius query only needs to look at the cubes around the query
+point. This works the same everywhere (no trouble at the poles or the
+dateline) and needs nothing beyond NumPy.
+
+"""
+
+import math
+import numpy as np
+
+# Same value as geopy.distance.EARTH_RADIUS, used by great_circle
+EARTH_RADIUS = 6371.009
+
+CELLSIZE = 10       # km, default size of the index cubes
+
+
+class SpatialIndex():
+    """
+Spatial index over lon/lat points.
+
+Usage:
+    index=SpatialIndex(lons,lats,[cellsize])
+
+    index.cells : cube label of each point, points in the same cube are
+        at most index.maxspan km apart
+    index.query(lon,lat,radius) : indices of the points within radius km
+    index.neighbours(radius,[weights]) : for each point, the number (or
+        sum of weights) of the other points within radius km
+    index.groups([keys]) : group label of each point; points share a
+        group if they are in the same cube (and have the same key)
+
+    """
+
+    def __init__(self,lons,lats,cellsize=CELLSIZE):
+
+        self.lons = np.asarray(lons,dtype=float)
+        self.lats = np.asarray(lats,dtype=float)
+        self.xyz = toXyz(self.lons,self.lats)
+        self.cellsize = cellsize
+        self.cubesize = chord(cellsize)
+
+        # Largest great-circle distance between two points in one cube
+        self.maxspan = arc(self.cubesize * math.sqrt(3))
+
+        ijk = np.floor(self.xyz / self.cubesize).astype(np.int64)
+        self.ijk = ijk
+        _,self.cells = np.unique(ijk,axis=0,return_inverse=True)
+        self.cells = self.cells.ravel()
+
+        self.buckets = {}
+        for n,key in enumerate(map(tuple,ijk)):
+            self.buckets.setdefault(key,[]).append(n)
+
+    def __len__(self):
+        return len(self.lons)
+
+    def query(self,lon,lat,radius):
+        """
+        Returns the indices (sorted) of the points within radius km
+        """
+
+        xyz = toXyz(np.array([lon]),np.array([lat]))[0]
+        return self._query(xyz,radius)
+
+    def _query(self,xyz,radius):
+        maxchord = chord(radius)
+        reach = int(math.ceil(maxchord / self.cubesize))
+        i0,j0,k0 = np.floor(xyz / self.cubesize).astype(np.int64)
+
+        candidates = []
+        for i in range(i0-reach,i0+reach+1):
+            for j in range(j0-reach,j0+reach+1):
+                for k in range(k0-reach,k0+reach+1):
+                    candidates.extend(self.buckets.get((i,j,k),()))
+
+        if not candidates:
+            return np.array([],dtype=int)
+
+        candidates = np.array(sorted(candidates))
+        chords = np.sqrt(((self.xyz[candidates] - xyz)**2).sum(axis=1))
+        return candidates[chords <= maxchord]
+
+    def neighbours(self,radius,weights=None):
+        """
+        For each point, returns the number of other points within
+        radius km, or the sum of their weights
+        """
+
+        if weights is None:
+            weights = np.ones(len(self))
+        weights = np.asarray(weights,dtype=float)
+
+        results = np.zeros(len(self))
+        for n in range(len(self)):
+            near = self._query(self.xyz[n],radius)
+            results[n] = weights[near].sum() - weights[n]
+        return results
+
+    def groups(self,keys=None):
+        """
+        Returns a group label (0..ngroups-1) for each point
+        Points share a group if they are in the same cube and, if keys
+        is given, have the same key
+        """
+
+        if keys is None:
+            return self.cells
+        columns = np.column_stack([self.cells,np.asarray(keys,dtype=float)])
+        _,labels = np.unique(columns,axis=0,return_inverse=True)
+        return labels.ravel()
+
+
+def toXyz(lons,lats):
+    """
+    Returns an (n,3) array of unit vectors for these points
+    """
+
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    return np.column_stack([np.cos(lats) * np.cos(lons),
+                            np.cos(lats) * np.sin(lons),
+                            np.sin(lats)])
+
+def toLonLat(xyz):
+    """
+    Returns (lons,lats) arrays for an (n,3) array of vectors
+    (the vectors do not need to be normalized)
+    """
+
+    x,y,z = xyz[:,0],xyz[:,1],xyz[:,2]
+    lats = np.degrees(np.arctan2(z,np.sqrt(x**2 + y**2)))
+    lons = np.degrees(np.arctan2(y,x))
+    return lons,lats
+
+def chord(dist):
+    """
+    Chord length on the unit sphere for a great-circle distance in km
+    """
+
+    return 2 * math.sin(min(dist / EARTH_RADIUS,math.pi) / 2)
+
+def arc(chordlength):
+    """
+    Great-circle distance in km for a chord length on the unit sphere
+    """
+
+    return 2 * EARTH_RADIUS * math.asin(min(chordlength / 2,1))
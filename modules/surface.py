@@ -0,0 +1,154 @@
+#! /usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+surface.py : Residual surface of the locator grid search
+
+Every grid searched by locate_dyfi.locate() is stored as dense NumPy
+arrays (magnitude, residual and rmsMI per grid offset) instead of one
+GeoJSON Feature per trial epicenter. The surface can be exported on
+demand as GeoJSON or as a compact .npz file, e.g. for plotting or
+uncertainty contours.
+
+"""
+
+import numpy as np
+import geojson
+
+PRECISION = 4
+
+
+class ResidualSurface():
+    """
+Residual surface of one locate() call.
+
+Usage:
+    surface=ResidualSurface()
+    loc=locate_dyfi.locate(obs,surface)
+
+    surface.grids : one dict per searched grid (levels and grid shifts)
+        level       search level (see locate_dyfi.SEARCH_LEVELS)
+        gridstep    grid spacing in km
+        gridsize    number of grid steps on each side of the center
+        center      (lon,lat) of the grid center
+        lon,lat     coordinates of each trial epicenter
+        mag,resid   results of each trial epicenter (NaN if none)
+        rmsMI       resid minus the best resid of the surface
+        All arrays have shape (2*gridsize+1,2*gridsize+1), indexed
+        [x offset,y offset] from West/South to East/North.
+    len(surface) : number of trial epicenters with a result
+
+    surface.toGeojson() : FeatureCollection of trial epicenters
+    surface.save(file) : save as .npz, see ResidualSurface.load(file)
+
+    """
+
+    def __init__(self):
+        self.grids = []
+        self.level = 0
+        self.bestresid = None
+
+    def __len__(self):
+        return sum([ int(np.isfinite(grid['resid']).sum())
+                     for grid in self.grids ])
+
+    def addGrid(self,center,gridstep,gridsize,lons,lats,mags,resids):
+        """
+        Add the results of one grid, given as flat arrays in grid order
+        (x offset outer, y offset inner)
+        """
+
+        shape = (2*gridsize+1,2*gridsize+1)
+        resids = np.asarray(resids,dtype=float).reshape(shape)
+        self.grids.append({
+            'level' : self.level,
+            'gridstep' : gridstep,
+            'gridsize' : gridsize,
+            'center' : tuple(center),
+            'lon' : np.asarray(lons,dtype=float).reshape(shape),
+            'lat' : np.asarray(lats,dtype=float).reshape(shape),
+            'mag' : np.asarray(mags,dtype=float).reshape(shape),
+            'resid' : np.where(np.isfinite(resids),resids,np.nan),
+            'rmsMI' : np.full(shape,np.nan)
+        })
+
+    def setBest(self,bestresid):
+        """
+        Set rmsMI = resid - bestresid for each trial epicenter
+        """
+
+        self.bestresid = bestresid
+        for grid in self.grids:
+            grid['rmsMI'] = np.round(grid['resid'] - bestresid,PRECISION)
+
+    def toGeojson(self):
+        """
+        Returns a FeatureCollection with one Point per trial epicenter
+        (properties mag, resid, rmsMI, ix, iy, level)
+        """
+
+        features = []
+        for grid in self.grids:
+            offsets = np.arange(-grid['gridsize'],grid['gridsize']+1)
+            offsets = offsets * grid['gridstep']
+            for i,j in zip(*np.nonzero(np.isfinite(grid['resid']))):
+                props = {
+                    'mag' : float(grid['mag'][i,j]),
+                    'resid' : float(grid['resid'][i,j]),
+                    'rmsMI' : float(grid['rmsMI'][i,j]),
+                    'ix' : int(offsets[i]), 'iy' : int(offsets[j]),
+                    'level' : grid['level']
+                }
+                pt = geojson.Point((float(grid['lon'][i,j]),
+                                    float(grid['lat'][i,j])))
+                features.append(geojson.Feature(geometry=pt,properties=props))
+
+        return geojson.FeatureCollection(features)
+
+    def save(self,file):
+        """
+        Save all grids as flat arrays in one compressed .npz file
+        """
+
+        columns = {}
+        for key in ('lon','lat','mag','resid','rmsMI'):
+            columns[key] = np.concatenate([ grid[key].ravel()
+                                            for grid in self.grids ])
+        for key in ('mag','resid','rmsMI'):
+            columns[key] = columns[key].astype(np.float32)
+
+        np.savez_compressed(file,
+            level=[ grid['level'] for grid in self.grids ],
+            gridstep=[ grid['gridstep'] for grid in self.grids ],
+            gridsize=[ grid['gridsize'] for grid in self.grids ],
+            center=np.array([ grid['center'] for grid in self.grids ]),
+            bestresid=np.nan if self.bestresid is None else self.bestresid,
+            **columns)
+
+    @classmethod
+    def load(cls,file):
+        surface = cls()
+        with np.load(file) as data:
+            start = 0
+            for n,level in enumerate(data['level']):
+                gridsize = int(data['gridsize'][n])
+                shape = (2*gridsize+1,2*gridsize+1)
+                end = start + shape[0]*shape[1]
+                grid = {
+                    'level' : int(level),
+                    'gridstep' : data['gridstep'][n].item(),
+                    'gridsize' : gridsize,
+                    'center' : tuple(data['center'][n].tolist()),
+                }
+                for key in ('lon','lat','mag','resid','rmsMI'):
+                    values = data[key][start:end].astype(float)
+                    if key not in ('lon','lat'):
+                        values = np.round(values,PRECISION)
+                    grid[key] = values.reshape(shape)
+                surface.grids.append(grid)
+                start = end
+
+            if np.isfinite(data['bestresid']):
+                surface.bestresid = float(data['bestresid'])
+
+        return surface
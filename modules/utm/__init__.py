@@ -1,3 +1,3 @@
 from modules.utm.conversion import to_latlon, from_latlon
+from modules.utm.conversion import to_latlon_array, from_latlon_array
 from modules.utm.error import OutOfRangeError
-
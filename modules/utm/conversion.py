@@ -1,7 +1,8 @@
 import math
+import numpy as np
 from .error import OutOfRangeError
 
-__all__ = ['to_latlon', 'from_latlon']
+__all__ = ['to_latlon', 'from_latlon', 'to_latlon_array', 'from_latlon_array']
 
 K0 = 0.9996
 
@@ -36,6 +37,10 @@ ZONE_LETTERS = [
     (-72, 'D'), (-80, 'C')
 ]
 
+# ZONE_LETTERS in ascending order, for the array functions
+_LETTER_BOUNDS = np.array([lat_min for lat_min, _ in reversed(ZONE_LETTERS)])
+_LETTERS = np.array([letter or '' for _, letter in reversed(ZONE_LETTERS)])
+
 
 def to_latlon(easting, northing, zone_number, zone_letter=None, northern=None):
 
@@ -194,3 +199,191 @@ def latlon_to_zone_number(latitude, longitude):
 
 def zone_number_to_central_longitude(zone_number):
     return (zone_number - 1) * 6 - 180 + 3
+
+
+def to_latlon_array(easting, northing, zone_number, zone_letter=None, northern=None):
+    """Array version of to_latlon.
+
+    easting, northing and zone_number are arrays (or scalars, broadcast
+    to the same shape). zone_letter is an array of letters or a single
+    letter; northern is an array of booleans or a single boolean. Points
+    can be in different zones.
+
+    Returns (latitude, longitude, valid). Instead of raising
+    OutOfRangeError, points out of range get valid=False and NaN
+    coordinates.
+    """
+
+    if zone_letter is None and northern is None:
+        raise ValueError('either zone_letter or northern needs to be set')
+
+    elif zone_letter is not None and northern is not None:
+        raise ValueError('set either zone_letter or northern, but not both')
+
+    easting = np.asarray(easting, dtype=float)
+    northing = np.asarray(northing, dtype=float)
+    zone_number = np.asarray(zone_number)
+    easting, northing, zone_number = np.broadcast_arrays(easting, northing, zone_number)
+
+    valid = ((100000 <= easting) & (easting < 1000000) &
+             (0 <= northing) & (northing <= 10000000) &
+             (1 <= zone_number) & (zone_number <= 60))
+
+    if zone_letter is not None:
+        zone_letter = np.char.upper(np.asarray(zone_letter, dtype=str))
+        valid &= ((zone_letter >= 'C') & (zone_letter <= 'X') &
+                  (zone_letter != 'I') & (zone_letter != 'O'))
+        northern = zone_letter >= 'N'
+
+    x = easting - 500000
+    y = np.where(northern, northing, northing - 10000000)
+
+    m = y / K0
+    mu = m / (R * M1)
+
+    p_rad = (mu +
+             P2 * np.sin(2 * mu) +
+             P3 * np.sin(4 * mu) +
+             P4 * np.sin(6 * mu) +
+             P5 * np.sin(8 * mu))
+
+    p_sin = np.sin(p_rad)
+    p_sin2 = p_sin * p_sin
+
+    p_cos = np.cos(p_rad)
+
+    p_tan = p_sin / p_cos
+    p_tan2 = p_tan * p_tan
+    p_tan4 = p_tan2 * p_tan2
+
+    ep_sin = 1 - E * p_sin2
+    ep_sin_sqrt = np.sqrt(1 - E * p_sin2)
+
+    n = R / ep_sin_sqrt
+    r = (1 - E) / ep_sin
+
+    c = _E * p_cos**2
+    c2 = c * c
+
+    d = x / (n * K0)
+    d2 = d * d
+    d3 = d2 * d
+    d4 = d3 * d
+    d5 = d4 * d
+    d6 = d5 * d
+
+    latitude = (p_rad - (p_tan / r) *
+                (d2 / 2 -
+                 d4 / 24 * (5 + 3 * p_tan2 + 10 * c - 4 * c2 - 9 * E_P2)) +
+                 d6 / 720 * (61 + 90 * p_tan2 + 298 * c + 45 * p_tan4 - 252 * E_P2 - 3 * c2))
+
+    longitude = (d -
+                 d3 / 6 * (1 + 2 * p_tan2 + c) +
+                 d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 + 24 * p_tan4)) / p_cos
+
+    latitude = np.where(valid, np.degrees(latitude), np.nan)
+    longitude = np.where(valid, np.degrees(longitude) +
+                         zone_number_to_central_longitude(zone_number), np.nan)
+
+    return latitude, longitude, valid
+
+
+def from_latlon_array(latitude, longitude, force_zone_number=None):
+    """Array version of from_latlon.
+
+    latitude and longitude are arrays (or scalars, broadcast to the same
+    shape). Each point gets its own zone, including the Norway/Svalbard
+    exceptions, unless force_zone_number is set.
+
+    Returns (easting, northing, zone_number, zone_letter, valid). Instead
+    of raising OutOfRangeError, points out of range get valid=False,
+    NaN easting/northing, zone number 0 and an empty zone letter.
+    """
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    latitude, longitude = np.broadcast_arrays(latitude, longitude)
+
+    valid = ((-80.0 <= latitude) & (latitude <= 84.0) &
+             (-180.0 <= longitude) & (longitude <= 180.0))
+
+    lat_rad = np.radians(latitude)
+    lat_sin = np.sin(lat_rad)
+    lat_cos = np.cos(lat_rad)
+
+    lat_tan = lat_sin / lat_cos
+    lat_tan2 = lat_tan * lat_tan
+    lat_tan4 = lat_tan2 * lat_tan2
+
+    if force_zone_number is None:
+        zone_number = latlon_to_zone_number_array(latitude, longitude)
+    else:
+        zone_number = np.broadcast_to(np.asarray(force_zone_number, dtype=int),
+                                      latitude.shape)
+
+    zone_letter = latitude_to_zone_letter_array(latitude)
+
+    lon_rad = np.radians(longitude)
+    central_lon = zone_number_to_central_longitude(zone_number)
+    central_lon_rad = np.radians(central_lon)
+
+    n = R / np.sqrt(1 - E * lat_sin**2)
+    c = E_P2 * lat_cos**2
+
+    a = lat_cos * (lon_rad - central_lon_rad)
+    a2 = a * a
+    a3 = a2 * a
+    a4 = a3 * a
+    a5 = a4 * a
+    a6 = a5 * a
+
+    m = R * (M1 * lat_rad -
+             M2 * np.sin(2 * lat_rad) +
+             M3 * np.sin(4 * lat_rad) -
+             M4 * np.sin(6 * lat_rad))
+
+    easting = K0 * n * (a +
+                        a3 / 6 * (1 - lat_tan2 + c) +
+                        a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * E_P2)) + 500000
+
+    northing = K0 * (m + n * lat_tan * (a2 / 2 +
+                                        a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) +
+                                        a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * E_P2)))
+
+    northing = np.where(latitude < 0, northing + 10000000, northing)
+
+    easting = np.where(valid, easting, np.nan)
+    northing = np.where(valid, northing, np.nan)
+    zone_number = np.where(valid, zone_number, 0)
+    zone_letter = np.where(valid, zone_letter, '')
+
+    return easting, northing, zone_number, zone_letter, valid
+
+
+def latitude_to_zone_letter_array(latitude):
+    """Array version of latitude_to_zone_letter ('' instead of None)"""
+
+    latitude = np.asarray(latitude, dtype=float)
+    i = np.searchsorted(_LETTER_BOUNDS, latitude, side='right') - 1
+    return np.where(i >= 0, _LETTERS[np.maximum(i, 0)], '')
+
+
+def latlon_to_zone_number_array(latitude, longitude):
+    """Array version of latlon_to_zone_number"""
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+
+    with np.errstate(invalid='ignore'):
+        zone_number = np.trunc((longitude + 180) / 6).astype(int) + 1
+
+    norway = (56 <= latitude) & (latitude <= 64) & (3 <= longitude) & (longitude <= 12)
+    zone_number = np.where(norway, 32, zone_number)
+
+    svalbard = (72 <= latitude) & (latitude <= 84) & (longitude >= 0)
+    for max_lon, number in ((9, 31), (21, 33), (33, 35), (42, 37)):
+        zone = svalbard & (longitude <= max_lon)
+        zone_number = np.where(zone, number, zone_number)
+        svalbard &= ~zone
+
+    return zone_number
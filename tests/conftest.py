@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import datetime
+
+import geojson
+import pytest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(TESTDIR))
+
+TRIGGER = os.path.join(TESTDIR,'..','triggers','1553137916.geojson')
+
+
+def loadRows():
+    """
+    Rows of tests/testdataset.json, with time_now as datetime like the
+    MySQL cursor returns them
+    """
+
+    with open(os.path.join(TESTDIR,'testdataset.json')) as f:
+        rows = json.load(f)
+    for row in rows:
+        row['time_now'] = datetime.datetime.strptime(row['time_now'],
+                                                     '%Y-%m-%dT%H:%M:%S')
+    return rows
+
+
+@pytest.fixture
+def rows():
+    return loadRows()
+
+
+@pytest.fixture
+def responses(rows):
+    """
+    The test dataset as Features, the way Db.row2geojson builds them
+    """
+
+    from modules.db import Db
+    return geojson.FeatureCollection([ Db.row2geojson(None,row)
+                                       for row in rows ])
+
+
+@pytest.fixture
+def trigger():
+    with open(TRIGGER) as f:
+        return json.load(f)['features']
@@ -0,0 +1,170 @@
+import math
+import json
+import random
+import datetime
+
+import geojson
+import pytest
+
+import modules.aggregate as aggregate
+import modules.cdi as cdi
+from modules.utm import to_latlon,from_latlon,OutOfRangeError
+
+LEVELS = aggregate.LEVELS
+
+
+def referenceAggregate(pts,resolution):
+    """
+    The per-point aggregation aggregate() replaced: UTM string key of
+    each response, CDI of each cell from the mean of each index
+    """
+
+    resolutionMeters = resolution * 1000
+    cells = {}
+    for pt in pts:
+        lon,lat = pt['geometry']['coordinates']
+        try:
+            x,y,zonenum,zoneletter = from_latlon(lat,lon)
+        except OutOfRangeError:
+            continue
+        x0 = int(math.floor(x/resolutionMeters) * resolutionMeters)
+        y0 = int(math.floor(y/resolutionMeters) * resolutionMeters)
+        loc = '{} {} {} {}'.format(x0,y0,zonenum,zoneletter)
+        cells.setdefault(loc,[]).append(pt)
+
+    results = []
+    for loc,cellpts in cells.items():
+        x,y,zone,zoneletter = loc.split()
+        lat,lon = to_latlon(int(x)+resolutionMeters/2,
+                            int(y)+resolutionMeters/2,int(zone),zoneletter)
+        coords = (round(lon,aggregate.PRECISION),round(lat,aggregate.PRECISION))
+        results.append(geojson.Feature(
+            geometry=geojson.Point(coords),
+            properties={ 'cdi':referenceCdi(cellpts),'nresp':len(cellpts) },
+            id=loc))
+
+    return results
+
+
+def referenceCdi(pts):
+    byindex = {}
+    for index in cdi.cdiIndices:
+        total = 0
+        num = 0
+        for pt in pts:
+            val = pt['properties'].get(index)
+            if val is None:
+                continue
+            try:
+                val = float(val)
+            except ValueError:
+                val = float(val.split(' ')[0])
+            total += val
+            num += 1
+        if num:
+            byindex[index] = total/num
+
+    cws = 0
+    for index in byindex:
+        cws += byindex[index] * cdi.cdiIndices[index]
+    if cws <= 0:
+        return 1
+    value = math.log(cws) * 3.3996 - 4.3781
+    if value < 2:
+        return 2
+    return round(value,1)
+
+
+def dump(features):
+    return json.dumps(features,sort_keys=True)
+
+
+@pytest.fixture
+def synthetic():
+    """
+    Random responses with raw string values, around the 84N/80S limits,
+    the antimeridian and the UTM zone 10/11 boundary, and inside a few
+    shared cells
+    """
+
+    rnd = random.Random(1)
+    values = [ None,'0','1','2 yes','3','0.5','4',1,2.5 ]
+    t0 = datetime.datetime(2019,3,1)
+    centers = [ (-120.0,35.0),(-117.9,34.2),(-117.9,34.2),(10.0,83.99),
+                (-60.0,-79.99),(179.99,-10.0) ]
+    features = []
+    for n in range(600):
+        lon0,lat0 = rnd.choice(centers)
+        lon = max(-180,min(179.999,lon0 + rnd.uniform(-0.05,0.05)))
+        lat = max(-80.5,min(84.5,lat0 + rnd.uniform(-0.05,0.05)))
+        props = { 'time_now':t0 + datetime.timedelta(seconds=10*n) }
+        for index in cdi.cdiIndices:
+            if rnd.random() < 0.8:
+                props[index] = rnd.choice(values)
+        features.append(geojson.Feature(
+            geometry=geojson.Point((lon,lat)),properties=props))
+    return geojson.FeatureCollection(features)
+
+
+@pytest.fixture(params=['testdataset','synthetic'])
+def data(request,responses,synthetic):
+    return responses if request.param=='testdataset' else synthetic
+
+
+@pytest.mark.parametrize('resolution',LEVELS)
+def test_aggregate(data,resolution):
+    results = aggregate.aggregate(data,resolution)
+    assert dump(results) == dump(referenceAggregate(data['features'],
+                                                    resolution))
+
+
+def test_pyramid(data):
+    pyramid = aggregate.aggregatePyramid(data,LEVELS)
+    for resolution in LEVELS:
+        assert dump(pyramid[resolution]) == \
+            dump(referenceAggregate(data['features'],resolution))
+
+
+@pytest.mark.parametrize('chunksize',[1,7,aggregate.CHUNKSIZE])
+def test_stream(data,chunksize):
+    pyramid = aggregate.aggregateStream(iter(data['features']),LEVELS,
+                                        chunksize)
+    for resolution in LEVELS:
+        assert dump(pyramid[resolution]) == \
+            dump(referenceAggregate(data['features'],resolution))
+
+
+def test_incremental(data):
+    pts = sorted(data['features'],key=lambda pt:pt['properties']['time_now'])
+    aggregator = aggregate.IncrementalAggregator(10)
+    window = []
+    for start in range(0,len(pts),50):
+        new = pts[start:start+50]
+        aggregator.add(new)
+        window += new
+
+        # Keep the last 120 responses or so
+        if len(window) > 120:
+            cut = window[-120]['properties']['time_now']
+            aggregator.expire(cut)
+            window = [ pt for pt in window
+                       if not pt['properties']['time_now'] < cut ]
+
+        reference = referenceAggregate(window,10)
+        assert len(aggregator) == sum(pt['properties']['nresp']
+                                      for pt in reference)
+        assert dump(aggregator.snapshot()) == dump(reference)
+
+
+def test_cellcache_roundtrip(tmp_path,data):
+    before = dump(aggregate.aggregate(data,10))
+    file = str(tmp_path / 'cells.npz')
+    aggregate.cellcache.save(file)
+    saved = aggregate.cellcache
+    try:
+        aggregate.cellcache = aggregate.CellCache()
+        assert aggregate.cellcache.load(file) > 0
+        assert dump(aggregate.aggregate(data,10)) == before
+        assert aggregate.cellcache.misses == 0
+    finally:
+        aggregate.cellcache = saved
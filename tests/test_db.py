@@ -0,0 +1,114 @@
+import os
+
+import mysql.connector
+import pytest
+
+import modules.db
+from modules.db import Db,ConnectionPool,FakeConnector
+
+from conftest import TESTDIR
+
+
+class StreamConnector():
+    """
+    Canned rows, read like an unbuffered mysql-connector cursor: the
+    connection is unusable until all the rows are read
+    """
+
+    def __init__(self,rows):
+        self.rows = rows
+        self.unread = False
+
+    def cursor(self,**kwargs):
+        return StreamCursor(self)
+
+    def is_connected(self):
+        return not self.unread
+
+    def close(self):
+        pass
+
+
+class StreamCursor():
+
+    def __init__(self,connector):
+        self.connector = connector
+        self.rows = []
+
+    def execute(self,text,params=None):
+        if self.connector.unread:
+            raise mysql.connector.InternalError('Unread result found')
+        self.rows = list(self.connector.rows)
+        self.connector.unread = True
+
+    def fetchmany(self,size=1):
+        rows,self.rows = self.rows[:size],self.rows[size:]
+        if not rows:
+            self.connector.unread = False
+        return rows
+
+    def fetchall(self):
+        rows,self.rows = self.rows,[]
+        self.connector.unread = False
+        return rows
+
+    def close(self):
+        if self.connector.unread:
+            raise mysql.connector.InternalError('Unread result found')
+
+
+def test_fake(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(TESTDIR))
+    db = Db({ 'fake':True })
+    assert len(db.extquery('cdi','latest','1')['features']) == 40
+    assert db.count('latest','1') == 40
+    with pytest.raises(RuntimeError):
+        next(db.aggiter('latest','1'))
+
+
+def test_no_connection(monkeypatch):
+    def connect(**kwargs):
+        raise mysql.connector.Error('no server')
+
+    monkeypatch.setattr(mysql.connector,'connect',connect)
+    monkeypatch.setattr(modules.db,'pools',{})
+    monkeypatch.setattr(modules.db.time,'sleep',lambda seconds:None)
+    with pytest.raises(mysql.connector.Error):
+        Db({ 'user':'u','password':'p','database':'d' })
+    pool = list(modules.db.pools.values())[0]
+    assert pool.failures == modules.db.RETRIES + 1
+
+
+def test_stop_early(monkeypatch,rows):
+    connector = StreamConnector(rows)
+    pool = ConnectionPool(lambda: connector,1)
+    monkeypatch.setattr(modules.db,'getpool',lambda *args:pool)
+    db = Db({},batchsize=5)
+
+    for results in [ db.iterquery('extended_2019','*','1'),
+                     db.windowiter('cdi','latest','2019-01-01 00:00:00') ]:
+        next(results)
+        results.close()
+        assert not connector.unread
+
+    assert len(list(db.iterquery('extended_2019','*','1'))) == len(rows)
+    assert pool.reconnects == 0
+
+
+def test_more_db_than_connections(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(TESTDIR))
+    pool = ConnectionPool(FakeConnector,2,timeout=5)
+    monkeypatch.setattr(modules.db,'getpool',lambda *args:pool)
+
+    dbs = [ Db({},poolsize=2) for i in range(5) ]
+    results = dbs[0].extquery('cdi','extended_2018,extended_2019','1')
+    assert len(results['features']) == 80
+    assert all(db.count('latest','1') == 40 for db in dbs)
+    assert pool.nopen <= 2
+
+
+def test_acquire_timeout():
+    pool = ConnectionPool(FakeConnector,1,timeout=0.2)
+    pool.acquire()
+    with pytest.raises(mysql.connector.errors.PoolError):
+        pool.acquire()
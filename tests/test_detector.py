@@ -0,0 +1,18 @@
+import math
+
+from modules.detector import RateIndex,poissonTail
+
+
+def test_poisson_tail():
+    assert poissonTail(0,2.0) == 1.0
+    assert math.isclose(poissonTail(1,2.0),1 - math.exp(-2.0))
+    assert poissonTail(5,0) == 0.0
+
+
+def test_detect_empty_window(responses):
+    index = RateIndex()
+    index.update(responses['features'],24)
+    anomalies = index.detect(responses['features'],0,mincount=1)
+    assert anomalies
+    assert all(a['prob'] == 0.0 and a['ratio'] == math.inf
+               for a in anomalies)
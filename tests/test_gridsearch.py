@@ -0,0 +1,51 @@
+import copy
+
+import pytest
+
+import modules.locate_dyfi as locate_dyfi
+from modules.aggregate import aggregate
+
+# The fixed two-pass search locate() used before SEARCH_LEVELS
+TWOPASS = [ (50,10),(5,10) ]
+
+
+def locateWith(monkeypatch,obs,**settings):
+    monkeypatch.setattr(locate_dyfi,'FARFIELD_GROUPING',0)
+    for key,value in settings.items():
+        monkeypatch.setattr(locate_dyfi,key,value)
+    loc = locate_dyfi.locate(copy.deepcopy(obs))
+    return (loc['geometry']['coordinates'],loc['properties']['mag'],
+            loc['properties']['resid'])
+
+
+def compareBackends(monkeypatch,obs,**settings):
+    python = locateWith(monkeypatch,obs,LOCATE_BACKEND='python',**settings)
+    numpy = locateWith(monkeypatch,obs,LOCATE_BACKEND='numpy',**settings)
+    assert numpy == python
+
+
+@pytest.mark.parametrize('residtype',['A','B'])
+@pytest.mark.parametrize('levels',[None,TWOPASS])
+def test_backends_testdataset(monkeypatch,responses,residtype,levels):
+    obs = aggregate(responses,10)
+    settings = { 'RESID_TYPE':residtype }
+    if levels:
+        settings.update(SEARCH_LEVELS=levels,SEARCH_MAXSHIFTS=0,
+                        FILTERBYLOC='')
+    compareBackends(monkeypatch,obs,**settings)
+
+
+def test_backends_trigger_A(monkeypatch,trigger):
+    compareBackends(monkeypatch,trigger,RESID_TYPE='A',
+                    SEARCH_LEVELS=TWOPASS,SEARCH_MAXSHIFTS=0,FILTERBYLOC='')
+
+
+def test_backends_trigger_B(monkeypatch,trigger):
+    # Before 0.3 the python backend reused the magnitude of observations
+    # rejected at this trial epicenter, and located this trigger at
+    # M6.0 (-80.4328,32.5714)
+    settings = { 'RESID_TYPE':'B','SEARCH_LEVELS':TWOPASS,
+                 'SEARCH_MAXSHIFTS':0,'FILTERBYLOC':'' }
+    compareBackends(monkeypatch,trigger,**settings)
+    loc = locateWith(monkeypatch,trigger,LOCATE_BACKEND='python',**settings)
+    assert loc == ([-83.0423,26.7668],4.8,0.2807)
@@ -0,0 +1,141 @@
+import json
+import random
+import sqlite3
+
+import pytest
+
+import modules.db
+import modules.aggregate as aggregate
+import modules.cdi as cdi
+from modules.db import Db,ConnectionPool
+
+LEVELS = aggregate.LEVELS
+
+COLUMNS = [ 'subid','latitude','longitude','time_now','eventid',
+            'other_felt' ] + list(cdi.cdiIndices)
+
+# Rows come back in subid order, as from the MySQL primary key
+SCHEMA = ','.join([ 'subid INTEGER PRIMARY KEY' ] + COLUMNS[1:])
+
+
+class SqliteConnector():
+    """
+    Stands in for the MySQL connector, over an in-memory SQLite database
+    """
+
+    def __init__(self,connection):
+        self.connection = connection
+
+    def cursor(self,**kwargs):
+        return SqliteCursor(self.connection.cursor())
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class SqliteCursor():
+    # Dict rows, like cursor(dictionary=True)
+
+    def __init__(self,cursor):
+        self.cursor = cursor
+
+    def execute(self,text,params=None):
+        self.cursor.execute(text,params or ())
+
+    def fetchall(self):
+        return [ dict(row) for row in self.cursor.fetchall() ]
+
+    def fetchmany(self,size=1):
+        return [ dict(row) for row in self.cursor.fetchmany(size) ]
+
+    def close(self):
+        self.cursor.close()
+
+
+def boundaryRows(n=300):
+    """
+    Responses with raw string values around the UTM zone 10/11 boundary
+    and packed into a few hundred meters elsewhere, several of them at
+    the same location, plus one without a location
+    """
+
+    rnd = random.Random(1)
+    values = [ None,'','null','0','1','1 yes','2 shaken','0.5','3' ]
+    locations = [ (round(lon0 + rnd.uniform(-size,size),5),
+                   round(lat0 + rnd.uniform(-size,size),5))
+                  for lon0,lat0,size in [ (-120.0,35.0,0.05),
+                                          (-117.9,34.2,0.003) ]
+                  for i in range(n // 6) ]
+    locations.append((None,None))
+
+    rows = []
+    for i in range(n):
+        lon,lat = rnd.choice(locations)
+        row = { 'subid':1000 + i,'latitude':lat,'longitude':lon,
+                'time_now':'2019-03-09 %02i:%02i:00' % (i // 60 % 24,i % 60),
+                'eventid':'unknown' }
+        for index in cdi.cdiIndices:
+            row[index] = rnd.choice(values)
+        rows.append(row)
+    return rows
+
+
+@pytest.fixture
+def db(monkeypatch,rows):
+    """
+    Db over an in-memory SQLite database: extended_2019 holds the test
+    dataset and the boundary rows, extended_2018 is empty
+    """
+
+    connection = sqlite3.connect(':memory:',check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    for table in [ 'extended_2018','extended_2019' ]:
+        connection.execute('CREATE TABLE %s (%s)' % (table,SCHEMA))
+
+    for row in rows:
+        row['time_now'] = str(row['time_now'])
+        row['eventid'] = 'unknown'
+    connection.executemany(
+        'INSERT INTO extended_2019 VALUES (%s)' % ','.join('?'*len(COLUMNS)),
+        [ [ row.get(column) for column in COLUMNS ]
+          for row in rows + boundaryRows() ])
+
+    pool = ConnectionPool(lambda: SqliteConnector(connection),1)
+    monkeypatch.setattr(modules.db,'getpool',lambda *args:pool)
+    yield Db({},poolsize=1)
+    connection.close()
+
+
+def dump(features):
+    return json.dumps(features,sort_keys=True)
+
+
+@pytest.mark.parametrize('table,text',[
+    ('extended_2019','1'),
+    ('extended_2018,extended_2019','eventid="unknown"'),
+    ('extended_2019','time_now>"2019-03-09 00:00:00"'),
+])
+def test_pushdown(db,table,text):
+    groups = list(db.aggiter(table,text))
+    responses = db.extquery('cdi',table,text)
+    locations = set(tuple(f['geometry']['coordinates'])
+                    for f in responses['features'])
+    assert len(groups) < len(locations)
+
+    pushdown = aggregate.aggregateGroups(groups,LEVELS)
+    pyramid = aggregate.aggregatePyramid(responses,LEVELS)
+    for resolution in LEVELS:
+        assert dump(pushdown[resolution]) == dump(pyramid[resolution])
+
+    assert sum(g['nresp'] for g in groups) == len(responses['features'])
+    assert min(g['mintime'] for g in groups) == \
+        min(f['properties']['time_now'] for f in responses['features'])
+
+
+def test_pushdown_empty(db):
+    assert list(db.aggiter('extended_2018','1')) == []
+    pushdown = aggregate.aggregateGroups([],LEVELS)
+    assert pushdown == { resolution:[] for resolution in LEVELS }